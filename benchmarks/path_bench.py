@@ -0,0 +1,114 @@
+# Copyright 2016 Hardcoded Software (http://www.hardcoded.net)
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Measures the cost of the hot ``Path`` operations.
+
+Run with ``python -m hscommon.benchmarks.path_bench``. Each benchmark is run with and without
+the optimization it measures so that the gain is visible on the same machine.
+"""
+
+import argparse
+from functools import wraps
+from inspect import signature
+import time
+
+from .. import path as pathmod
+from ..path import Path, pathify
+
+def make_strings(count):
+    # Looks like what a scanner produces: many files spread over a limited number of folders, with
+    # the folder paths being parsed over and over.
+    folders = ['/home/user/music/artist{}/album{}'.format(i % 50, i % 400) for i in range(2000)]
+    return [folders[i % len(folders)] for i in range(count)]
+
+uncached_parse = pathmod._parse_str.__wrapped__
+
+def uncached_eq(self, other):
+    # How Path.__eq__ used to work: always convert ``other``.
+    return tuple.__eq__(self, Path(other))
+
+def old_pathify(f):
+    # How pathify used to work: go through every argument on every call.
+    sig = signature(f)
+    pindexes = {i for i, p in enumerate(sig.parameters.values()) if p.annotation is Path}
+    pkeys = {k: v for k, v in sig.parameters.items() if v.annotation is Path}
+    def path_or_none(p):
+        return None if p is None else Path(p)
+
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        args = tuple((path_or_none(a) if i in pindexes else a) for i, a in enumerate(args))
+        kwargs = {k: (path_or_none(v) if k in pkeys else v) for k, v in kwargs.items()}
+        return f(*args, **kwargs)
+
+    return wrapped
+
+def helper(path: Path, other, flag=False):
+    return path
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def bench_parse(strings):
+    for s in strings:
+        Path(s)
+
+def bench_eq(pairs):
+    for p1, p2 in pairs:
+        p1 == p2
+
+def bench_call(func, args):
+    for a in args:
+        func(a, 42, flag=True)
+
+def run_with(attrs, func, *args):
+    # Temporarily replaces ``attrs`` ({(obj, name): value}) while ``func`` runs.
+    old = {key: getattr(*key) for key in attrs}
+    for (obj, name), value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        return timed(func, *args)
+    finally:
+        for (obj, name), value in old.items():
+            setattr(obj, name, value)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark Path parsing and comparison.")
+    parser.add_argument(
+        '--count', type=int, default=1000000,
+        help="Number of paths created and compared (default: 1000000)"
+    )
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    strings = make_strings(args.count)
+    paths = [Path(s) for s in strings]
+    # Half of the comparisons are between equal paths, half between different paths.
+    pairs = [
+        (p, tuple(p) if i % 2 else paths[i - 1])
+        for i, p in enumerate(paths)
+    ]
+    pathmod._parse_str.cache_clear()
+    results = [
+        ('parse', 'cached', timed(bench_parse, strings)),
+        ('parse', 'uncached', run_with(
+            {(pathmod, '_parse_str'): uncached_parse}, bench_parse, strings
+        )),
+        ('eq', 'fast', timed(bench_eq, pairs)),
+        ('eq', 'convert', run_with({(Path, '__eq__'): uncached_eq}, bench_eq, pairs)),
+        ('pathify', 'none', timed(bench_call, helper, paths)),
+        ('pathify', 'new', timed(bench_call, pathify(helper), paths)),
+        ('pathify', 'old', timed(bench_call, old_pathify(helper), paths)),
+    ]
+    print("{:<10}{:<10}{:>12}{:>16}".format('benchmark', 'variant', 'seconds', 'ops/sec'))
+    for name, variant, elapsed in results:
+        print("{:<10}{:<10}{:>12.3f}{:>16.0f}".format(name, variant, elapsed, args.count / elapsed))
+
+if __name__ == '__main__':
+    main()
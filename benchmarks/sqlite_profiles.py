@@ -0,0 +1,84 @@
+# Copyright 2016 Hardcoded Software (http://www.hardcoded.net)
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Compares the PRAGMA profiles of ``hscommon.sqlite`` on synthetic workloads.
+
+Run with ``python -m hscommon.benchmarks.sqlite_profiles``.
+"""
+
+import argparse
+import os.path as op
+import random
+import tempfile
+import time
+
+from ..sqlite import ThreadedConn, PROFILES
+
+def bench_bulk_insert(con, count):
+    con.executemany(
+        'insert into foo(name, size) values(?, ?)',
+        (('file%d' % i, i * 10) for i in range(count))
+    )
+    con.commit()
+
+def bench_single_inserts(con, count):
+    # One transaction per row, the worst case for durable profiles.
+    for i in range(count // 100):
+        con.execute('insert into foo(name, size) values(?, ?)', ['single%d' % i, i])
+        con.commit()
+
+def bench_point_reads(con, count):
+    rowcount = con.execute('select max(rowid) from foo')[0][0]
+    rand = random.Random(0)
+    for i in range(count // 10):
+        con.execute('select name, size from foo where rowid = ?', [rand.randint(1, rowcount)])
+
+def bench_scan(con, count):
+    for i in range(5):
+        con.execute('select count(*), sum(size) from foo where name like ?', ['%9%'])
+
+WORKLOADS = [
+    ('bulk insert', bench_bulk_insert),
+    ('single inserts', bench_single_inserts),
+    ('point reads', bench_point_reads),
+    ('scan', bench_scan),
+]
+
+def run_profile(profile, count, tmpdir):
+    dbpath = op.join(tmpdir, '{}.db'.format(profile))
+    con = ThreadedConn(dbpath, False, profile=profile)
+    con.execute('create table foo(name TEXT, size INTEGER)')
+    con.commit()
+    timings = []
+    for name, func in WORKLOADS:
+        start = time.perf_counter()
+        func(con, count)
+        timings.append(time.perf_counter() - start)
+    con.close()
+    return timings
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Compare ThreadedConn PRAGMA profiles.")
+    parser.add_argument(
+        '--rows', type=int, default=100000,
+        help="Number of rows inserted by the bulk insert workload (default: 100000)"
+    )
+    parser.add_argument(
+        '--profiles', nargs='+', default=sorted(PROFILES),
+        help="Profiles to compare (default: all)"
+    )
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print("{:<15}".format("profile") + "".join("{:>16}".format(n) for n, f in WORKLOADS))
+        for profile in args.profiles:
+            timings = run_profile(profile, args.rows, tmpdir)
+            print("{:<15}".format(profile) + "".join("{:>15.3f}s".format(t) for t in timings))
+
+if __name__ == '__main__':
+    main()
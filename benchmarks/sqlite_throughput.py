@@ -0,0 +1,198 @@
+# Copyright 2016 Hardcoded Software (http://www.hardcoded.net)
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Measures the cost of going through ``ThreadedConn`` compared to a raw sqlite3 connection.
+
+Run with ``python -m hscommon.benchmarks.sqlite_throughput``. Results are printed and, with
+``--output``, saved as JSON so that runs can be compared over time.
+"""
+
+import argparse
+import json
+import os.path as op
+import platform
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from ..sqlite import ThreadedConn
+
+class RawTarget:
+    # A raw connection shared between threads the usual way: behind a lock.
+    name = 'raw'
+
+    def __init__(self, dbpath):
+        self._con = sqlite3.connect(dbpath, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._con.close()
+
+    def execute(self, sql, values=()):
+        with self._lock:
+            return self._con.execute(sql, values).fetchall()
+
+    def executemany(self, sql, seq_of_values):
+        with self._lock:
+            self._con.execute('BEGIN')
+            self._con.executemany(sql, seq_of_values)
+            self._con.execute('COMMIT')
+
+
+class ThreadedTarget:
+    name = 'threaded'
+
+    def __init__(self, dbpath):
+        self._con = ThreadedConn(dbpath, True)
+
+    def close(self):
+        self._con.close()
+
+    def execute(self, sql, values=()):
+        return self._con.execute(sql, values)
+
+    def executemany(self, sql, seq_of_values):
+        self._con.transaction(lambda con: con.executemany(sql, seq_of_values))
+
+
+TARGETS = [RawTarget, ThreadedTarget]
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def bench_single_inserts(target, count, threads):
+    latencies = [
+        timed(target.execute, 'insert into foo(name, size) values(?, ?)', ['single%d' % i, i])
+        for i in range(count // 10)
+    ]
+    return len(latencies), latencies
+
+def bench_bulk_inserts(target, count, threads):
+    batchsize = 1000
+    latencies = []
+    for start in range(0, count, batchsize):
+        rows = [('bulk%d' % i, i) for i in range(start, min(start + batchsize, count))]
+        sql = 'insert into foo(name, size) values(?, ?)'
+        latencies.append(timed(target.executemany, sql, rows))
+    return count, latencies
+
+def bench_point_reads(target, count, threads):
+    rowcount = target.execute('select max(rowid) from foo')[0][0]
+    rand = random.Random(0)
+    sql = 'select name, size from foo where rowid = ?'
+    latencies = [timed(target.execute, sql, [rand.randint(1, rowcount)]) for i in range(count)]
+    return len(latencies), latencies
+
+def bench_large_scans(target, count, threads):
+    latencies = [timed(target.execute, 'select name, size from foo') for i in range(5)]
+    return len(latencies), latencies
+
+def bench_mixed_clients(target, count, threads):
+    # Each client thread does 80% point reads and 20% single row inserts.
+    def client(seed):
+        rand = random.Random(seed)
+        for i in range(count // threads):
+            if rand.random() < 0.8:
+                sql = 'select name, size from foo where rowid = ?'
+                values = [rand.randint(1, rowcount)]
+            else:
+                sql, values = 'insert into foo(name, size) values(?, ?)', ['mixed', i]
+            latencies.append(timed(target.execute, sql, values))
+
+    rowcount = target.execute('select max(rowid) from foo')[0][0]
+    latencies = [] # list.append is thread-safe
+    clients = [threading.Thread(target=client, args=(i, )) for i in range(threads)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    return len(latencies), latencies
+
+# Order matters: later benchmarks read the rows inserted by the earlier ones.
+BENCHMARKS = [
+    ('single_inserts', bench_single_inserts),
+    ('bulk_inserts', bench_bulk_inserts),
+    ('point_reads', bench_point_reads),
+    ('large_scans', bench_large_scans),
+    ('mixed_clients', bench_mixed_clients),
+]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * p), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def run_target(target_class, count, threads, tmpdir):
+    dbpath = op.join(tmpdir, '{}.db'.format(target_class.name))
+    target = target_class(dbpath)
+    target.execute('create table foo(name TEXT, size INTEGER)')
+    results = {}
+    for name, func in BENCHMARKS:
+        start = time.perf_counter()
+        ops, latencies = func(target, count, threads)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results[name] = {
+            'ops': ops,
+            'seconds': elapsed,
+            'ops_per_sec': ops / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    target.close()
+    return results
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark ThreadedConn against raw sqlite3.")
+    parser.add_argument(
+        '--rows', type=int, default=100000,
+        help="Number of rows inserted by the bulk inserts benchmark (default: 100000)"
+    )
+    parser.add_argument(
+        '--threads', type=int, default=4,
+        help="Number of client threads in the mixed clients benchmark (default: 4)"
+    )
+    parser.add_argument(
+        '--output',
+        help="Path of a JSON file to save the results in"
+    )
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'rows': args.rows,
+        'threads': args.threads,
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for target_class in TARGETS:
+            report['results'][target_class.name] = run_target(
+                target_class, args.rows, args.threads, tmpdir
+            )
+    print("{:<16}{:<10}{:>14}{:>12}{:>12}".format(
+        'benchmark', 'target', 'ops/sec', 'p50 (ms)', 'p99 (ms)'
+    ))
+    for name, func in BENCHMARKS:
+        for target_class in TARGETS:
+            result = report['results'][target_class.name][name]
+            print("{:<16}{:<10}{:>14.0f}{:>12.3f}{:>12.3f}".format(
+                name, target_class.name, result['ops_per_sec'], result['p50_ms'], result['p99_ms']
+            ))
+    if args.output:
+        with open(args.output, 'wt') as fp:
+            json.dump(report, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
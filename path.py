@@ -6,14 +6,43 @@
 # which should be included with this package. The terms are also available at 
 # http://www.gnu.org/licenses/gpl-3.0.html
 
+import errno
 import logging
 import os
 import os.path as op
 import shutil
+import stat
 import sys
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from itertools import takewhile
-from functools import wraps
-from inspect import signature
+from functools import wraps, lru_cache
+from inspect import signature, Parameter
+
+from .jobprogress.job import nulljob
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# Number of strings for which the parsed Path is kept. Scanners create Paths from the same strings
+# (parent folders, mostly) over and over.
+PARSE_CACHE_SIZE = 2 ** 16
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_str(value, separator):
+    # Returns a Path. Paths are immutable, so the cached instances can be shared.
+    if value:
+        if (separator not in value) and ('/' in value):
+            separator = '/'
+        value = value.split(separator)
+        if (len(value) > 1) and (not value[-1]):
+            value = value[:-1]
+    else:
+        value = ()
+    return tuple.__new__(Path, value)
 
 class Path(tuple):
     """A handy class to work with paths.
@@ -46,12 +75,8 @@ class Path(tuple):
         if isinstance(value, bytes):
             value = unicode_if_needed(value)
         if isinstance(value, str):
-            if value:
-                if (separator not in value) and ('/' in value):
-                    separator = '/'
-                value = value.split(separator)
-            else:
-                value = ()
+            result = _parse_str(value, separator)
+            return result if cls is Path else tuple.__new__(cls, result)
         else:
             if any(isinstance(x, bytes) for x in value):
                 value = [unicode_if_needed(x) for x in value]
@@ -76,6 +101,12 @@ class Path(tuple):
             return tuple.__contains__(self, item)
     
     def __eq__(self, other):
+        if isinstance(other, tuple):
+            # Fast path: no conversion needed if the elements are already the same.
+            if tuple.__eq__(self, other):
+                return True
+            if isinstance(other, Path):
+                return False
         return tuple.__eq__(self, Path(other))
     
     def __getitem__(self, key):
@@ -157,10 +188,50 @@ class Path(tuple):
         return op.exists(str(self))
     
     def copy(self, dest_path):
-        return shutil.copy(str(self), str(dest_path))
+        """Same as ``shutil.copy()``, but copies data kernel-side when possible.
+
+        See :func:`copy_file`.
+        """
+        return copy_file(str(self), str(dest_path))
 
-    def copytree(self, dest_path, *args, **kwargs):
-        return shutil.copytree(str(self), str(dest_path), *args, **kwargs)
+    def copytree(self, dest_path, *args, workers=4, j=nulljob, **kwargs):
+        """Same as ``shutil.copytree()``, but copies files concurrently on ``workers`` threads.
+
+        Files are copied with :func:`copy_file` (and their metadata with ``shutil.copystat()``), so
+        ``copy_function`` isn't supported. Copied bytes are reported to ``j``. Errors are gathered
+        and raised as a single ``shutil.Error`` at the end, like ``shutil.copytree()`` does.
+        """
+        if 'copy_function' in kwargs:
+            raise TypeError("Path.copytree() doesn't support copy_function")
+        engine = CopyEngine(workers, copy_metadata=shutil.copystat)
+        dirs = {}
+        def copy_function(src, dst):
+            dirs[op.dirname(dst)] = op.dirname(src)
+            engine.submit(src, dst)
+            return dst
+        kwargs['copy_function'] = copy_function
+        errors = []
+        try:
+            result = shutil.copytree(str(self), str(dest_path), *args, **kwargs)
+        except shutil.Error as e:
+            # copytree() went through the whole tree anyway, our queued copies must be completed.
+            errors.extend(e.args[0])
+        except BaseException:
+            engine.cancel()
+            raise
+        try:
+            engine.wait(j, "Copying files")
+        except shutil.Error as e:
+            errors.extend(e.args[0])
+        # Creating files in a folder changes its mtime, so we copy folder stats again.
+        for dst, src in dirs.items():
+            try:
+                shutil.copystat(src, dst)
+            except OSError as e:
+                errors.append((src, dst, str(e)))
+        if errors:
+            raise shutil.Error(errors)
+        return result
 
     def isdir(self):
         return op.isdir(str(self))
@@ -171,7 +242,20 @@ class Path(tuple):
     def islink(self):
         return op.islink(str(self))
 
-    def listdir(self):
+    def listdir(self, with_stat=False):
+        """Returns the paths of the directory's entries.
+
+        With ``with_stat``, returns the result of :meth:`scandir` after having fetched the stat
+        info of every entry.
+        """
+        if with_stat:
+            result = self.scandir()
+            for p in result:
+                try:
+                    p.entry.stat()
+                except OSError:
+                    pass # will be raised again when stat() is called
+            return result
         return [self[name] for name in os.listdir(str(self))]
 
     def mkdir(self, *args, **kwargs):
@@ -198,9 +282,546 @@ class Path(tuple):
     def rmtree(self):
         return shutil.rmtree(str(self))
 
+    def scandir(self):
+        """Returns the directory's entries as :class:`ScannedPath` instances.
+
+        Unlike :meth:`listdir`, entry types (and stat info, once fetched) are cached in the
+        returned paths, saving a syscall for each ``isdir()``, ``isfile()`` or ``stat()`` call.
+        """
+        with os.scandir(str(self)) as it:
+            return [ScannedPath(self, entry) for entry in it]
+
     def stat(self):
         return os.stat(str(self))
     
+    def walk(self, include=None, exclude=None, max_depth=None, follow_symlinks=False,
+            workers=8, j=nulljob):
+        """Yields every path under ``self``, recursively, as :class:`ScannedPath` instances.
+
+        Directories are listed concurrently by ``workers`` threads and paths are yielded as soon
+        as their directory has been listed, so the order in which they come is undefined.
+
+        :param include: ``include(path)`` returns whether ``path`` is yielded. Directories that
+                        aren't included are still walked into.
+        :param exclude: ``exclude(path)`` returns whether ``path`` is skipped. Excluded
+                        directories aren't walked into.
+        :param max_depth: The entries of ``self`` are at depth 1. Directories at ``max_depth``
+                          aren't walked into. ``None`` means no limit.
+        :param follow_symlinks: Whether symlinks to directories are walked into. When they are,
+                                directories that are their own ancestor (through a symlink
+                                pointing to a parent directory) aren't walked into again.
+        :param j: A :class:`~hscommon.jobprogress.job.Job` to report progress to. Progress is the
+                  ratio of listed directories on found directories, so it can go backwards.
+
+        Directories that can't be listed are logged and skipped.
+        """
+        def listdir(path):
+            try:
+                return path.scandir()
+            except OSError as e:
+                logging.warning('Could not list "%s": %s', str(path), str(e))
+                return []
+
+        def ancestors_of(p, parent_ancestors):
+            # Returns the (st_dev, st_ino) of ``p`` and its ancestors, or None if ``p`` is one of
+            # its own ancestors. Only needed when following symlinks.
+            if not follow_symlinks:
+                return None
+            try:
+                st = p.stat()
+            except OSError:
+                return None
+            key = (st.st_dev, st.st_ino)
+            if key in parent_ancestors:
+                return None
+            return parent_ancestors | {key}
+
+        j.start_job(100, "Scanning folders")
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # future: (depth, ancestors)
+        pending = {executor.submit(listdir, self): (1, ancestors_of(self, frozenset()))}
+        found_count = 1
+        done_count = 0
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth, ancestors = pending.pop(future)
+                    done_count += 1
+                    for p in future.result():
+                        if exclude is not None and exclude(p):
+                            continue
+                        if (max_depth is None or depth < max_depth) \
+                                and p.entry.is_dir(follow_symlinks=follow_symlinks):
+                            p_ancestors = ancestors_of(p, ancestors)
+                            if not follow_symlinks or p_ancestors is not None:
+                                pending[executor.submit(listdir, p)] = (depth + 1, p_ancestors)
+                                found_count += 1
+                        if include is None or include(p):
+                            yield p
+                desc = "Scanned %d/%d folders" % (done_count, found_count)
+                j.set_progress(done_count * 100 // found_count, desc)
+        finally:
+            # We get here early if the job is cancelled or if the generator is closed.
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+    
+class ScannedPath(Path):
+    """A :class:`Path` returned by :meth:`Path.scandir`.
+
+    Holds the ``os.DirEntry`` it was created from in ``entry`` and answers type and stat queries
+    from it. Like ``os.DirEntry``, the info reflects the state of the file at the time it was
+    scanned. Paths derived from it (``parent()``, ``p['foo']``) are regular paths.
+    """
+    # Can't have __slots__: non-empty slots aren't supported in tuple subclasses.
+    def __new__(cls, parent, entry):
+        result = tuple.__new__(cls, tuple.__add__(parent, (entry.name, )))
+        result.entry = entry
+        return result
+
+    def __reduce__(self):
+        # The DirEntry can't be pickled. We unpickle as a regular Path.
+        return (Path, (tuple(self), ))
+
+    def isdir(self):
+        return self.entry.is_dir()
+
+    def isfile(self):
+        return self.entry.is_file()
+
+    def islink(self):
+        return self.entry.is_symlink()
+
+    def stat(self):
+        return self.entry.stat()
+
+
+# Copy engine: Copies are done by the kernel when possible: a reflink on filesystems that support
+# it (the data isn't even copied), then copy_file_range(), then sendfile(), and finally a plain
+# read/write loop.
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+FICLONE = 0x40049409 # from linux/fs.h
+# Errors meaning that a copy method isn't supported for this pair of files.
+_UNSUPPORTED_ERRNOS = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF,
+    errno.ENOTSOCK, errno.EPERM,
+}
+
+def _reflink(infd, outfd, size, progress):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(outfd, FICLONE, infd)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_ERRNOS or e.errno == errno.ENOTTY:
+            return False
+        raise
+    progress(size)
+    return True
+
+def _kernel_copy(copyfunc):
+    # Returns a function copying with ``copyfunc(infd, outfd, offset, count)`` until EOF.
+    def copy(infd, outfd, size, progress):
+        offset = 0
+        while True:
+            try:
+                copied = copyfunc(infd, outfd, offset, COPY_CHUNK_SIZE)
+            except OSError as e:
+                if offset == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+                    return False
+                raise
+            if not copied:
+                # Nothing copied at all: some filesystems (procfs, sysfs, FUSE) report EOF
+                # instead of an error. Let the next method try.
+                return offset > 0
+            offset += copied
+            progress(copied)
+    
+    return copy
+
+def _copy_file_range(infd, outfd, offset, count):
+    return os.copy_file_range(infd, outfd, count, offset, offset)
+
+def _sendfile(infd, outfd, offset, count):
+    return os.sendfile(outfd, infd, offset, count)
+
+def _readwrite(infd, outfd, size, progress):
+    while True:
+        data = os.read(infd, COPY_CHUNK_SIZE)
+        if not data:
+            return True
+        view = memoryview(data)
+        while view:
+            written = os.write(outfd, view)
+            view = view[written:]
+        progress(len(data))
+
+COPY_METHODS = [_reflink]
+if hasattr(os, 'copy_file_range'):
+    COPY_METHODS.append(_kernel_copy(_copy_file_range))
+if hasattr(os, 'sendfile'):
+    COPY_METHODS.append(_kernel_copy(_sendfile))
+
+def _copy_data(src, dst, progress):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        size = os.fstat(infd).st_size
+        # Files in /proc and the likes report a 0 size. We can only copy them by reading them.
+        methods = COPY_METHODS if size else []
+        for method in methods:
+            if method(infd, outfd, size, progress):
+                return
+        _readwrite(infd, outfd, size, progress)
+
+def copy_file(src, dst, progress=None, copy_metadata=shutil.copymode):
+    """Copies ``src`` to ``dst`` like ``shutil.copy()`` does and returns the destination.
+
+    Data is copied kernel-side when the platform and the filesystem support it. ``progress``, if
+    set, is called with the number of bytes copied every now and then. ``copy_metadata(src, dst)``
+    is called once the data is copied.
+    """
+    if op.isdir(dst):
+        dst = op.join(dst, op.basename(src))
+    # Like shutil.copyfile(), we don't want to block forever opening a named pipe. We also refuse
+    # other special files: kernel-side copy methods don't support them.
+    st = os.stat(src)
+    if not stat.S_ISREG(st.st_mode):
+        raise shutil.SpecialFileError("`{}` is not a regular file".format(src))
+    try:
+        if stat.S_ISFIFO(os.stat(dst).st_mode):
+            raise shutil.SpecialFileError("`{}` is a named pipe".format(dst))
+    except FileNotFoundError:
+        pass
+    try:
+        if op.samefile(src, dst):
+            raise shutil.SameFileError("{!r} and {!r} are the same file".format(src, dst))
+    except FileNotFoundError:
+        pass
+    _copy_data(src, dst, progress or (lambda count: None))
+    if copy_metadata is not None:
+        copy_metadata(src, dst)
+    return dst
+
+class CopyEngine:
+    """Copies files concurrently on a pool of ``workers`` threads.
+
+    Call :meth:`submit` for each file to copy, then :meth:`wait`, which reports the progress and
+    raises the errors.
+    """
+    def __init__(self, workers=4, copy_metadata=shutil.copymode):
+        self.copy_metadata = copy_metadata
+        self.total_bytes = 0
+        self.copied_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _progress(self, count):
+        with self._lock:
+            self.copied_bytes += count
+
+    def _copy(self, src, dst):
+        return copy_file(src, dst, self._progress, self.copy_metadata)
+
+    def cancel(self):
+        """Cancels the copies that haven't started yet. Ongoing copies are completed."""
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, src, dst):
+        src = os.fspath(src)
+        dst = os.fspath(dst)
+        try:
+            self.total_bytes += os.stat(src).st_size
+        except OSError:
+            pass # we'll get the error in the copy itself
+        self._futures[self._executor.submit(self._copy, src, dst)] = (src, dst)
+
+    def wait(self, j=nulljob, desc=''):
+        """Waits for all copies to end, reporting copied bytes to ``j``.
+
+        Returns the list of the destination paths. Raises ``shutil.Error`` with the list of
+        ``(src, dst, reason)`` if any copy failed.
+        """
+        j.start_job(self.total_bytes, desc)
+        pending = set(self._futures)
+        try:
+            while pending:
+                _, pending = wait(pending, timeout=0.1)
+                j.set_progress(self.copied_bytes, desc)
+        except BaseException:
+            self.cancel()
+            raise
+        self._executor.shutdown()
+        result = []
+        errors = []
+        for future, (src, dst) in self._futures.items():
+            try:
+                result.append(future.result())
+            except OSError as e:
+                errors.append((src, dst, str(e)))
+        if errors:
+            raise shutil.Error(errors)
+        return result
+
+
+def copy_many(pairs, workers=4, j=nulljob):
+    """Copies each ``(src, dst)`` of ``pairs`` concurrently with a :class:`CopyEngine`.
+
+    Returns the list of destination paths.
+    """
+    engine = CopyEngine(workers)
+    try:
+        for src, dst in pairs:
+            engine.submit(str(src), str(dst))
+    except BaseException:
+        engine.cancel()
+        raise
+    return engine.wait(j, "Copying files")
+
+class PathStore:
+    """Compact storage for a large number of paths.
+
+    Paths are stored as a tree of components: each path is a node pointing to its parent node, and
+    component names are interned. A million files under a few deep folders thus only store their
+    common folders once. Each path is identified by an integer handle and the corresponding
+    :class:`Path` is only built when asked for::
+
+        store = PathStore()
+        handle = store.add('/foo/bar')
+        store[handle] --> Path('/foo/bar')
+
+    Every parent of an added path gets a handle too. Handle ``0`` is the empty path.
+    """
+    ROOT = 0
+
+    def __init__(self):
+        self._parents = array('q', [-1])
+        self._names = [''] # interned
+        self._children = {} # parent handle: {name: handle}
+
+    def __contains__(self, path):
+        return self.find(path) is not None
+
+    def __getitem__(self, handle):
+        return tuple.__new__(Path, reversed(self.components(handle)))
+
+    def __len__(self):
+        return len(self._parents) - 1 # we don't count the root
+
+    def add(self, path):
+        """Adds ``path`` (and all its parents) to the store and returns its handle.
+
+        If ``path`` is already in the store, its existing handle is returned.
+        """
+        handle = self.ROOT
+        for name in Path(path):
+            handle = self.child(handle, name)
+        return handle
+
+    def child(self, handle, name):
+        """Returns the handle of ``name`` under ``handle``, adding it if needed."""
+        try:
+            children = self._children[handle]
+        except KeyError:
+            children = self._children[handle] = {}
+        try:
+            return children[name]
+        except KeyError:
+            name = sys.intern(name)
+            self._parents.append(handle)
+            self._names.append(name)
+            result = children[name] = len(self._parents) - 1
+            return result
+
+    def components(self, handle):
+        """Returns the components of ``handle``, from the last one to the first one."""
+        result = []
+        parents = self._parents
+        names = self._names
+        while handle > 0:
+            result.append(names[handle])
+            handle = parents[handle]
+        return result
+
+    def find(self, path):
+        """Returns the handle of ``path``, or ``None`` if it's not in the store."""
+        handle = self.ROOT
+        for name in Path(path):
+            handle = self._children.get(handle, {}).get(name)
+            if handle is None:
+                return None
+        return handle
+
+    def name(self, handle):
+        return self._names[handle]
+
+    def parent(self, handle):
+        """Returns the handle of ``handle``'s parent (``-1`` for the root)."""
+        return self._parents[handle]
+
+class PathSet:
+    """A set of paths indexed by their components.
+
+    Lookups depend on the depth of the looked up path, not on the number of paths in the set. It's
+    meant for things like "is this file in one of the excluded folders?". Like with
+    ``Path.__contains__``, a path is considered to be under itself.
+    """
+    # Each node is a {name: node} dict. Nodes holding a path of the set have a None key.
+    def __init__(self, paths=()):
+        self._root = {}
+        self._len = 0
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        node = self._find(Path(path))
+        return node is not None and None in node
+
+    def __iter__(self):
+        return self._iter_node(self._root, Path(()))
+
+    def __len__(self):
+        return self._len
+
+    def _find(self, path):
+        node = self._root
+        for name in path:
+            node = node.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _iter_node(self, node, path):
+        # Iterative to avoid hitting the recursion limit on deep trees.
+        stack = [(node, path)]
+        while stack:
+            node, path = stack.pop()
+            for name, child in node.items():
+                if name is None:
+                    yield path
+                else:
+                    stack.append((child, Path(tuple.__add__(path, (name, )))))
+
+    def add(self, path):
+        node = self._root
+        for name in Path(path):
+            node = node.setdefault(name, {})
+        if None not in node:
+            node[None] = True
+            self._len += 1
+
+    def descendants_of(self, path):
+        """Yields the paths of the set that are under ``path`` (including ``path`` itself)."""
+        path = Path(path)
+        node = self._find(path)
+        if node is None:
+            return iter(())
+        return self._iter_node(node, path)
+
+    def has_ancestor_of(self, path):
+        """Returns whether ``path`` is under (or is) one of the paths of the set."""
+        node = self._root
+        if None in node:
+            return True
+        for name in Path(path):
+            node = node.get(name)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def longest_prefix(self, path):
+        """Returns the deepest path of the set that ``path`` is under, or ``None``."""
+        path = Path(path)
+        node = self._root
+        result = Path(()) if None in node else None
+        for i, name in enumerate(path, start=1):
+            node = node.get(name)
+            if node is None:
+                break
+            if None in node:
+                result = path[:i]
+        return result
+
+    def remove(self, path):
+        """Removes ``path`` from the set. Raises ``KeyError`` if it isn't there."""
+        path = Path(path)
+        nodes = [self._root]
+        for name in path:
+            node = nodes[-1].get(name)
+            if node is None:
+                raise KeyError(path)
+            nodes.append(node)
+        if None not in nodes[-1]:
+            raise KeyError(path)
+        del nodes[-1][None]
+        self._len -= 1
+        # Prune the nodes that became empty
+        for name, parent in zip(reversed(path), reversed(nodes[:-1])):
+            if parent[name]:
+                break
+            del parent[name]
+
+
+class StatArrays:
+    """Stat info of a list of paths, as returned by :func:`stat_many`.
+
+    Every attribute is indexed like the path list: ``sizes[i]`` is the size of ``paths[i]``. For
+    paths that couldn't be stat'ed, ``failed[i]`` is 1, ``errors[i]`` is the error and the other
+    values are 0.
+    """
+    def __init__(self, count):
+        self.sizes = array('q', [0]) * count
+        self.mtimes = array('d', [0]) * count
+        self.inodes = array('Q', [0]) * count
+        self.modes = array('L', [0]) * count
+        self.failed = bytearray(count)
+        self.errors = {}
+
+    def __len__(self):
+        return len(self.failed)
+
+
+def stat_many(paths, workers=8, chunk_size=1000):
+    """Stats all ``paths`` (:class:`Path` or ``str``) on ``workers`` threads.
+
+    Returns a :class:`StatArrays`. Errors are recorded in it instead of being raised. Work is handed
+    out ``chunk_size`` paths at a time.
+    """
+    paths = list(paths)
+    result = StatArrays(len(paths))
+
+    def stat_range(start):
+        # Each call writes to its own indexes, so we don't need a lock.
+        for i in range(start, min(start + chunk_size, len(paths))):
+            p = paths[i]
+            try:
+                st = p.stat() if isinstance(p, Path) else os.stat(p)
+            except OSError as e:
+                result.failed[i] = 1
+                result.errors[i] = e
+            else:
+                result.sizes[i] = st.st_size
+                result.mtimes[i] = st.st_mtime
+                result.inodes[i] = st.st_ino
+                result.modes[i] = st.st_mode
+
+    starts = range(0, len(paths), chunk_size)
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() so that exceptions in stat_range() aren't silently ignored
+            list(executor.map(stat_range, starts))
+    else:
+        for start in starts:
+            stat_range(start)
+    return result
+
 def pathify(f):
     """Ensure that every annotated :class:`Path` arguments are actually paths.
     
@@ -214,18 +835,50 @@ def pathify(f):
     Calling ``foo('/bar', 0)`` will convert ``'/bar'`` to ``Path('/bar')``.
     """
     sig = signature(f)
-    pindexes = {i for i, p in enumerate(sig.parameters.values()) if p.annotation is Path}
-    pkeys = {k: v for k, v in sig.parameters.items() if v.annotation is Path}
-    def path_or_none(p):
-        return None if p is None else Path(p)
-    
-    @wraps(f)
-    def wrapped(*args, **kwargs):
-        args = tuple((path_or_none(a) if i in pindexes else a) for i, a in enumerate(args))
-        kwargs = {k: (path_or_none(v) if k in pkeys else v) for k, v in kwargs.items()}
-        return f(*args, **kwargs)
-    
-    return wrapped
+    annotated = [
+        p.name for p in sig.parameters.values()
+        if p.annotation is Path and p.kind not in {Parameter.VAR_POSITIONAL, Parameter.VAR_KEYWORD}
+    ]
+    if not annotated:
+        return f
+    return wraps(f)(_make_pathify_wrapper(f, sig, annotated))
+
+class _SourceRepr:
+    # Used to have inspect render a default value as a name in our generated source.
+    def __init__(self, name):
+        self.name = name
+    
+    def __repr__(self):
+        return self.name
+    
+def _make_pathify_wrapper(f, sig, annotated):
+    # We generate the source of a wrapper having the same signature as ``f``. It only looks at the
+    # annotated arguments and doesn't go through *args/**kwargs, so it's almost free to call.
+    namespace = {'_pathify_func': f, '_pathify_Path': Path}
+    params = []
+    callargs = []
+    for p in sig.parameters.values():
+        if p.default is not Parameter.empty:
+            defaultname = '_pathify_default_' + p.name
+            namespace[defaultname] = p.default
+            p = p.replace(default=_SourceRepr(defaultname))
+        params.append(p.replace(annotation=Parameter.empty))
+        if p.kind == Parameter.VAR_POSITIONAL:
+            callargs.append('*' + p.name)
+        elif p.kind == Parameter.KEYWORD_ONLY:
+            callargs.append('{0}={0}'.format(p.name))
+        elif p.kind == Parameter.VAR_KEYWORD:
+            callargs.append('**' + p.name)
+        else:
+            callargs.append(p.name)
+    wrapped_sig = sig.replace(parameters=params, return_annotation=Parameter.empty)
+    lines = ['def wrapped{}:'.format(wrapped_sig)]
+    for name in annotated:
+        lines.append('    if {0} is not None and not isinstance({0}, _pathify_Path):'.format(name))
+        lines.append('        {0} = _pathify_Path({0})'.format(name))
+    lines.append('    return _pathify_func({})'.format(', '.join(callargs)))
+    exec('\n'.join(lines), namespace)
+    return namespace['wrapped']
 
 def log_io_error(func):
     """ Catches OSError, IOError and WindowsError and log them
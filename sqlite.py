@@ -8,134 +8,1749 @@
 
 import sys
 import os
+import re
+import logging
 import os.path as op
 import threading
-from queue import Queue
+import itertools
+import bisect
+import heapq
+import zlib
+from collections import deque, OrderedDict, defaultdict
+from functools import wraps
+from queue import Empty
+from concurrent.futures import Future
 import time
+import asyncio
 import sqlite3 as sqlite
+from array import array
+
+from .jobprogress.job import nulljob
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 STOP = object()
 COMMIT = object()
 ROLLBACK = object()
 
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+# STOP is always served last, after all queries queued before it.
+_PRIORITY_STOP = 3
+
+_chdir_lock = threading.Lock()
+
+# PRAGMA tuning profiles. See ThreadedConn.
+PROFILES = {
+    # Fast writes, at the expense of durability: a crash in the middle of the load can corrupt
+    # the database.
+    'bulk-load': [
+        ('journal_mode', 'MEMORY'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -256 * 1024), # in KiB
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 256 * 1024 * 1024),
+    ],
+    # Readers don't block writers and a crash can only lose the last transactions.
+    'interactive': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -64 * 1024),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 256 * 1024 * 1024),
+    ],
+    # Committed transactions survive a power loss.
+    'durable': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', -16 * 1024),
+        ('temp_store', 'DEFAULT'),
+        ('mmap_size', 0),
+    ],
+}
+
+def profile_queries(profile, exclude=()):
+    """Returns the PRAGMA statements of ``profile``, a key of ``PROFILES``.
+    
+    Pragmas named in ``exclude`` are left out.
+    """
+    try:
+        pragmas = PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown profile: {!r}".format(profile))
+    return ['PRAGMA {} = {}'.format(name, value) for name, value in pragmas if name not in exclude]
+
+# Statements that can't write. A WITH clause can end with a write statement, so it only counts when
+# there's no write keyword in it.
+RE_READONLY = re.compile(r'^\s*(select|explain|values)\b', re.IGNORECASE)
+RE_WITH = re.compile(r'^\s*with\b', re.IGNORECASE)
+RE_WRITE_KEYWORD = re.compile(r'\b(insert|update|delete|replace)\b', re.IGNORECASE)
+RE_DML = re.compile(r'^\s*(insert|update|delete|replace)\b', re.IGNORECASE)
+
+def is_readonly(sql):
+    """Returns whether ``sql`` is a statement that can't modify the database."""
+    if RE_READONLY.match(sql):
+        return True
+    return bool(RE_WITH.match(sql)) and not RE_WRITE_KEYWORD.search(sql)
+
 class FakeCursor(list):
     # It's not possible to use sqlite cursors on another thread than the connection. Thus,
     # we can't directly return the cursor. We have to fatch all results, and support its interface.
+    # Fetched rows used to be popped, which made fetchone() O(n). We now keep a read position and
+    # only drop the rows before it when the list is used as a list (see _compacting()) or when
+    # they become the majority. len(), iteration and indexing skip them without dropping them.
+    _index = 0
+    
+    def __getitem__(self, key):
+        if not self._index:
+            return list.__getitem__(self, key)
+        if isinstance(key, int):
+            if key < 0:
+                key += len(self)
+            if key < 0:
+                raise IndexError("list index out of range")
+            return list.__getitem__(self, key + self._index)
+        self._compact()
+        return list.__getitem__(self, key)
+    
+    def __iter__(self):
+        if not self._index:
+            return list.__iter__(self)
+        return itertools.islice(list.__iter__(self), self._index, None)
+    
+    def __len__(self):
+        return list.__len__(self) - self._index
+    
+    def _compact(self):
+        if self._index:
+            list.__delitem__(self, slice(0, self._index))
+            self._index = 0
+    
+    def _consumed(self, count):
+        self._index += count
+        if self._index * 2 > list.__len__(self):
+            self._compact()
+    
     def fetchall(self):
+        self._compact()
         return self
     
+    def fetchmany(self, size=1):
+        result = list.__getitem__(self, slice(self._index, self._index + size))
+        self._consumed(len(result))
+        return result
+    
     def fetchone(self):
         try:
-            return self.pop(0)
+            result = list.__getitem__(self, self._index)
         except IndexError:
             return None
+        self._consumed(1)
+        return result
+    
+
+def _compacting(name):
+    method = getattr(list, name)
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._compact()
+        return method(self, *args, **kwargs)
+    
+    return wrapper
+
+# Every other list method drops the fetched rows first, so that they never show up.
+for _name in [
+        '__add__', '__contains__', '__delitem__', '__eq__', '__ge__', '__gt__', '__iadd__',
+        '__imul__', '__le__', '__lt__', '__mul__', '__ne__', '__reduce_ex__', '__repr__',
+        '__reversed__', '__rmul__', '__setitem__', 'clear', 'copy', 'count', 'extend', 'index',
+        'insert', 'pop', 'remove', 'reverse', 'sort']:
+    setattr(FakeCursor, _name, _compacting(_name))
+del _name
+
+class StreamingCursor:
+    """Iterates over the results of a query by fetching them from the DB thread in chunks.
+    
+    Created by :meth:`ThreadedConn.stream`. At most two chunks of ``chunksize`` rows are held in
+    memory at once: the one being consumed and the next one, which is prefetched in the background.
+    The underlying sqlite cursor lives on the DB thread until the results are exhausted or
+    :meth:`close` is called.
+    """
+    def __init__(self, thread, cursor_id, rows, chunksize):
+        self._t = thread
+        self._cursor_id = cursor_id
+        self._rows = deque(rows)
+        self._chunksize = chunksize
+        self._next = None
+        if cursor_id is not None:
+            self._prefetch()
+    
+    def __del__(self):
+        self.close()
+    
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+    
+    def _prefetch(self):
+        t, cursor_id, chunksize = self._t, self._cursor_id, self._chunksize
+        self._next = t.submit_query(lambda con: t.fetch_chunk(cursor_id, chunksize))
+    
+    def _fill(self):
+        # Returns False if there's nothing left to fill.
+        if self._next is None:
+            return False
+        rows = self._next.result()
+        self._next = None
+        if rows is None: # Connection closed
+            rows = []
+        self._rows.extend(rows)
+        if len(rows) < self._chunksize:
+            self._cursor_id = None # the DB thread closed the cursor
+        else:
+            self._prefetch()
+        return bool(rows)
+    
+    def close(self):
+        if self._cursor_id is None:
+            return
+        t, cursor_id = self._t, self._cursor_id
+        self._cursor_id = None
+        self._next = None
+        self._rows.clear()
+        t.submit_query(lambda con: t.close_cursor(cursor_id))
+    
+    def fetchall(self):
+        result = []
+        while self._rows or self._fill():
+            result.extend(self._rows)
+            self._rows.clear()
+        return result
+    
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self._chunksize
+        while len(self._rows) < size and self._fill():
+            pass
+        rows = self._rows
+        return [rows.popleft() for i in range(min(size, len(rows)))]
+    
+    def fetchone(self):
+        if not self._rows and not self._fill():
+            return None
+        return self._rows.popleft()
+    
+
+class BlobHandle:
+    """Incremental access to a BLOB, through the DB thread.
+    
+    Created by :meth:`ThreadedConn.blobopen`. Works like a file and like ``sqlite3.Blob``, which it
+    wraps, except that reads and writes are done ``chunksize`` bytes at a time, each chunk being a
+    separate trip to the DB thread. Other queries can thus be executed between two chunks of a big
+    blob. :meth:`readinto` copies each chunk directly into the caller's buffer.
+    
+    A blob's size can't be changed. Writing past its end raises ``ValueError``. ``on_write``, if
+    set, is called after each :meth:`write`.
+    """
+    def __init__(self, thread, blob_id, length, chunksize, on_write=None):
+        self._t = thread
+        self._blob_id = blob_id
+        self._length = length
+        self._chunksize = chunksize
+        self._on_write = on_write
+    
+    def __del__(self):
+        self.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def __len__(self):
+        return self._length
+    
+    def _call(self, func):
+        if self._blob_id is None:
+            raise ValueError("Blob is closed")
+        t, blob_id = self._t, self._blob_id
+        result = t._query(lambda con: func(t._blobs[blob_id]))
+        if result is None: # Connection closed
+            raise ValueError("Blob's connection is closed")
+        return result
+    
+    def close(self):
+        if self._blob_id is None:
+            return
+        t, blob_id = self._t, self._blob_id
+        self._blob_id = None
+        t.submit_query(lambda con: t.close_blob(blob_id))
+    
+    def read(self, length=-1):
+        """Reads ``length`` bytes from the current position (or up to the end if negative)."""
+        remaining = self._length - self.tell()
+        if length < 0 or length > remaining:
+            length = remaining
+        buffer = bytearray(length)
+        read = self.readinto(buffer)
+        return bytes(buffer[:read])
+    
+    def readinto(self, buffer):
+        """Reads up to ``len(buffer)`` bytes into ``buffer``. Returns the number of bytes read."""
+        view = memoryview(buffer).cast('B')
+        total = 0
+        chunksize = self._chunksize
+        while total < len(view):
+            chunk = view[total:total+chunksize]
+            def read_chunk(blob):
+                data = blob.read(len(chunk))
+                chunk[:len(data)] = data
+                return (len(data), )
+            read, = self._call(read_chunk)
+            total += read
+            if read < len(chunk):
+                break
+        return total
+    
+    def seek(self, offset, origin=os.SEEK_SET):
+        self._call(lambda blob: (blob.seek(offset, origin), ))
+        return self.tell()
+    
+    def tell(self):
+        return self._call(lambda blob: (blob.tell(), ))[0]
+    
+    def write(self, data):
+        """Writes ``data``, which can be any bytes-like object, at the current position."""
+        view = memoryview(data).cast('B')
+        chunksize = self._chunksize
+        try:
+            for start in range(0, len(view), chunksize):
+                chunk = view[start:start+chunksize]
+                self._call(lambda blob: (blob.write(chunk), ))
+        finally:
+            if self._on_write is not None:
+                self._on_write()
+        return len(view)
+    
+
+class _Backup:
+    # A query copying the database to ``dest_path``. After each step of ``pages_per_step`` pages,
+    # the queries queued in the meantime are executed. Changes they make to the database are
+    # picked up by the backup because they're made through the same connection.
+    def __init__(self, thread, dest_path, pages_per_step, j):
+        self.thread = thread
+        self.dest_path = dest_path
+        self.pages_per_step = pages_per_step
+        self.j = j
+        self.con = None
+        self.started = False
+    
+    def __call__(self, con):
+        self.con = con
+        target = sqlite.connect(self.dest_path)
+        try:
+            con.backup(target, pages=self.pages_per_step, progress=self.progress)
+        finally:
+            target.close()
+            self.con = None
+    
+    def progress(self, status, remaining, total):
+        if not self.started:
+            self.started = True
+            self.j.start_job(total, "Backing up database")
+        self.j.set_progress(total - remaining)
+        if remaining:
+            self.thread.serve_pending(self.con)
+    
+
+def _execute(con, sql, values):
+    cur = con.execute(sql, values)
+    result = FakeCursor(cur.fetchall())
+    result.lastrowid = cur.lastrowid
+    return result
+
+def _executemany(con, sql, seq_of_values):
+    cur = con.executemany(sql, seq_of_values)
+    result = FakeCursor()
+    result.lastrowid = cur.lastrowid
+    result.rowcount = cur.rowcount
+    return result
+
+def _run_transaction(con, unit):
+    # When a transaction is already pending, ``unit`` becomes a savepoint in it, and its changes
+    # are committed along with the pending transaction.
+    nested = con.in_transaction
+    con.execute('SAVEPOINT unit' if nested else 'BEGIN')
+    try:
+        if callable(unit):
+            result = unit(con)
+        else:
+            result = _execute_batch(con, unit)
+    except BaseException:
+        if nested:
+            con.execute('ROLLBACK TO unit')
+            con.execute('RELEASE unit')
+        elif con.in_transaction:
+            con.rollback()
+        raise
+    if nested:
+        con.execute('RELEASE unit')
+    else:
+        con.commit()
+    return result
+
+def _extend_column(column, values):
+    # Columns start as int64 arrays and are downgraded to float64 arrays, then to lists, as values
+    # that don't fit come in.
+    if isinstance(column, array):
+        size = len(column)
+        try:
+            column.extend(values)
+            return column
+        except (TypeError, OverflowError):
+            # extend() keeps the values appended before the one that failed.
+            del column[size:]
+        if column.typecode == 'q' and all(isinstance(v, (int, float)) for v in values):
+            try:
+                result = array('d', column)
+                result.extend(values)
+                return result
+            except OverflowError: # int too big for a float
+                pass
+        column = column.tolist()
+    column.extend(values)
+    return column
+
+def _execute_columnar(con, sql, values, use_numpy, chunksize):
+    cur = con.execute(sql, values)
+    if cur.description is None:
+        return {}
+    names = [desc[0] for desc in cur.description]
+    columns = [array('q') for name in names]
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if not rows:
+            break
+        for i, column_values in enumerate(zip(*rows)):
+            columns[i] = _extend_column(columns[i], column_values)
+    if use_numpy and numpy is not None:
+        dtypes = {'q': numpy.int64, 'd': numpy.float64}
+        columns = [
+            numpy.frombuffer(c, dtype=dtypes[c.typecode]) if isinstance(c, array) else c
+            for c in columns
+        ]
+    return dict(zip(names, columns))
+
+def _explain(con, sql, values):
+    return [tuple(row) for row in con.execute('EXPLAIN QUERY PLAN ' + sql, values)]
+
+def _execute_batch(con, queries):
+    # If a statement fails, the statements before it stay executed (in autocommit mode) or pending
+    # in the current transaction, just as if they had been sent through execute() one at a time.
+    return [_execute(con, sql, values) for sql, values in queries]
+
+RE_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+RE_NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+RE_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+RE_WHITESPACE = re.compile(r'\s+')
+
+def normalize_sql(sql):
+    """Returns ``sql`` with its literals replaced by ``?`` and its whitespace collapsed.
+    
+    Statements differing only by their literal values or by the length of their ``IN (?, ?, ...)``
+    lists are normalized to the same string.
+    """
+    sql = RE_STRING_LITERAL.sub('?', sql)
+    sql = RE_NUMBER_LITERAL.sub('?', sql)
+    sql = RE_PLACEHOLDER_LIST.sub('?', sql)
+    return RE_WHITESPACE.sub(' ', sql).strip()
+
+class StatementStats:
+    """Timings collected by :class:`QueryMetrics` for a normalized statement.
+    
+    Times are in seconds. ``histogram`` counts executions by total latency (queued time excluded),
+    the count at index ``i`` being for latencies lower than ``LATENCY_BUCKETS[i]``. The last count
+    is for latencies above the last bucket.
+    """
+    LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.queued_time = 0
+        self.execute_time = 0
+        self.fetch_time = 0
+        self.max_time = 0
+        self.rows = 0
+        self.histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+    
+    def add(self, queued_time, execute_time, fetch_time, rows):
+        self.count += 1
+        self.queued_time += queued_time
+        self.execute_time += execute_time
+        self.fetch_time += fetch_time
+        self.rows += rows
+        elapsed = execute_time + fetch_time
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[bisect.bisect_right(self.LATENCY_BUCKETS, elapsed)] += 1
+    
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the ``p`` percentile (``0 <= p <= 1``).
+        
+        Returns ``None`` if that percentile is above the last bucket.
+        """
+        threshold = p * self.count
+        total = 0
+        for bucket, count in zip(self.LATENCY_BUCKETS, self.histogram):
+            total += count
+            if count and total >= threshold:
+                return bucket
+        return None
+    
+
+class QueryMetrics:
+    """Collects timings for the queries going through a :class:`ThreadedConn`.
+    
+    Pass an instance to ``ThreadedConn``'s ``metrics`` argument. Statements are grouped by their
+    :func:`normalize_sql` form in ``statements``, a dict of :class:`StatementStats`. Other
+    queries (executemany, batches, cursor fetches) aren't timed individually.
+    
+    ``queue_depth`` and ``max_queue_depth`` are the number of queries waiting to be picked up by the
+    DB thread. ``lock_wait_time`` is the total time spent by callers waiting to enqueue a query.
+    
+    When a statement takes ``slow_query_threshold`` seconds or more to execute and fetch,
+    ``on_slow_query(sql, elapsed, plan)`` is called with ``plan`` being the rows returned by
+    ``EXPLAIN QUERY PLAN`` for it. It's called on the DB thread, so it has to be quick.
+    """
+    def __init__(self, slow_query_threshold=None, on_slow_query=None):
+        self.slow_query_threshold = slow_query_threshold
+        self.on_slow_query = on_slow_query
+        self.statements = {}
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.lock_wait_time = 0
+        self.max_lock_wait_time = 0
+        self._lock = threading.Lock()
+    
+    def record_enqueue(self, queue_depth, lock_wait_time):
+        with self._lock:
+            self.queue_depth = queue_depth
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            self.lock_wait_time += lock_wait_time
+            self.max_lock_wait_time = max(self.max_lock_wait_time, lock_wait_time)
+    
+    def record_dequeue(self, queue_depth):
+        self.queue_depth = queue_depth
+    
+    def record_statement(self, sql, queued_time, execute_time, fetch_time, rows):
+        key = normalize_sql(sql)
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            stats.add(queued_time, execute_time, fetch_time, rows)
+    
+    def record_error(self, sql):
+        key = normalize_sql(sql)
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            stats.errors += 1
+    
+    def is_slow(self, elapsed):
+        return self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold
+    
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.max_queue_depth = self.queue_depth
+            self.lock_wait_time = 0
+            self.max_lock_wait_time = 0
+    
+
+def _table_key(dbname, table):
+    # How tables are identified in the result cache
+    table = table.lower()
+    if dbname is None or dbname == 'main':
+        return table
+    return dbname.lower() + '.' + table
+
+class _TableTracker:
+    # Records the tables read and written by each statement, as reported by sqlite's authorizer.
+    # Unlike parsing the SQL, this sees joins, views and triggers. The authorizer is only called
+    # when a statement is prepared and sqlite3 reuses prepared statements, so the tables are kept,
+    # for each SQL string, in a dict shared by the threads of a connection.
+    MAX_STATEMENTS = 10000
+    WRITE_ACTIONS = {sqlite.SQLITE_INSERT, sqlite.SQLITE_UPDATE, sqlite.SQLITE_DELETE}
+    
+    def __init__(self):
+        self._statements = {} # sql: (read tables, written tables)
+        self._local = threading.local()
+    
+    def authorize(self, action, arg1, arg2, dbname, source):
+        collected = getattr(self._local, 'collected', None)
+        if collected is not None and arg1:
+            if action == sqlite.SQLITE_READ:
+                collected[0].add(_table_key(dbname, arg1))
+            elif action in self.WRITE_ACTIONS:
+                collected[1].add(_table_key(dbname, arg1))
+        return sqlite.SQLITE_OK
+    
+    def read_by(self, sql):
+        """Returns the tables read by ``sql``, ``None`` if unknown."""
+        entry = self._statements.get(sql)
+        return entry[0] if entry is not None else None
+    
+    def track(self, sql, func, *args):
+        # Calls func(*args), which executes ``sql``, and records the tables reported meanwhile.
+        read, written = self._local.collected = (set(), set())
+        try:
+            return func(*args)
+        finally:
+            self._local.collected = None
+            # Nothing is reported when a prepared statement is reused, we keep what we had.
+            if read or written:
+                if len(self._statements) >= self.MAX_STATEMENTS:
+                    self._statements = {}
+                self._statements[sql] = (frozenset(read), frozenset(written))
+    
+    def written_by(self, sql):
+        """Returns the tables written by ``sql``, ``None`` if unknown."""
+        entry = self._statements.get(sql)
+        return entry[1] if entry is not None else None
+    
+
+class _TrackingConnection(sqlite.Connection):
+    # Connection recording the tables used by the statements it executes in its ``tracker``.
+    tracker = None
+    
+    def execute(self, sql, *args):
+        return self.tracker.track(sql, sqlite.Connection.execute, self, sql, *args)
+    
+    def executemany(self, sql, *args):
+        return self.tracker.track(sql, sqlite.Connection.executemany, self, sql, *args)
+    
+
+def _cache_key(sql, values):
+    # Returns the ResultCache key of a query, ``None`` if its values are unhashable.
+    try:
+        if isinstance(values, dict):
+            key = (sql, tuple(sorted(values.items())))
+        else:
+            key = (sql, tuple(values))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _estimate_size(rows):
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in rows
+    )
+
+class ResultCache:
+    """LRU cache of SELECT results, invalidated by writes, used by :class:`ThreadedConn`.
+    
+    Results are keyed by ``(sql, values)`` and evicted, least recently used first, when there's
+    more than ``max_entries`` of them or when their estimated size goes over ``max_memory`` bytes.
+    Each result is associated with the tables its query read (as reported by sqlite, which
+    includes the tables behind views). A write to a table drops the results associated with it.
+    Queries that don't read a table (``select changes()``) aren't cached and statements for which
+    we don't know the tables written (DDL, for example) clear the whole cache.
+    
+    Tables written to since the last commit or rollback are tracked and invalidated again on
+    rollback and commit, as results cached in between may hold uncommitted data.
+    """
+    def __init__(self, max_entries=100, max_memory=None):
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        # Bumped at each invalidation. A result is only stored if no invalidation happened since
+        # its query was sent, otherwise it could be stale.
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._by_table = defaultdict(set)
+        self._dirty_tables = set()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def _remove(self, key):
+        rows, tables, size = self._entries.pop(key)
+        self.memory -= size
+        for table in tables:
+            keys = self._by_table[table]
+            keys.discard(key)
+            if not keys:
+                del self._by_table[table]
+    
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._by_table.clear()
+            self._dirty_tables.clear()
+            self.memory = 0
+    
+    def end_transaction(self):
+        with self._lock:
+            tables = self._dirty_tables
+            self._dirty_tables = set()
+        self.invalidate_tables(tables)
+    
+    def get(self, key):
+        with self._lock:
+            try:
+                rows, tables, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return FakeCursor(rows)
+    
+    def invalidate_writes(self, tables):
+        """Invalidates results after a statement wrote to ``tables``.
+        
+        If ``tables`` is empty or ``None`` (unknown), the whole cache is cleared.
+        """
+        if not tables:
+            self.clear()
+            return
+        with self._lock:
+            self._dirty_tables.update(tables)
+        self.invalidate_tables(tables)
+    
+    def invalidate_tables(self, tables):
+        with self._lock:
+            self.generation += 1
+            for table in tables:
+                for key in list(self._by_table.get(table, ())):
+                    self._remove(key)
+    
+    def put(self, key, tables, result, generation):
+        if not tables or self.max_entries <= 0:
+            return
+        rows = list(result)
+        size = _estimate_size(rows)
+        if self.max_memory is not None and size > self.max_memory:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (rows, tables, size)
+            self.memory += size
+            for table in tables:
+                self._by_table[table].add(key)
+            while len(self._entries) > self.max_entries or \
+                    (self.max_memory is not None and self.memory > self.max_memory):
+                self._remove(next(iter(self._entries)))
+    
+
+class PriorityQueueStats:
+    """Queue statistics for a priority level of a :class:`ThreadedConn`.
+    
+    ``promoted`` is the number of queries served ahead of higher priority ones because they had
+    been waiting for too long. Times are in seconds.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.served = 0
+        self.promoted = 0
+        self.total_wait = 0
+        self.max_wait = 0
+    
+
+class _SchedulingQueue:
+    # A queue serving items by priority (lower values first), FIFO within a priority. To prevent
+    # starvation, an item waiting for more than ``max_wait`` seconds is served before items of
+    # higher priority.
+    def __init__(self, max_wait):
+        self.max_wait = max_wait
+        self.stats = [PriorityQueueStats() for i in range(_PRIORITY_STOP + 1)]
+        self._queues = [deque() for i in range(_PRIORITY_STOP + 1)]
+        self._count = 0
+        self._cond = threading.Condition(threading.Lock())
+    
+    def _pop(self):
+        queues = self._queues
+        level = next(i for i, q in enumerate(queues) if q)
+        now = time.perf_counter()
+        promoted = None
+        if self.max_wait is not None:
+            for i in range(level + 1, _PRIORITY_STOP):
+                q = queues[i]
+                if q and now - q[0][0] >= self.max_wait:
+                    if promoted is None or q[0][0] < queues[promoted][0][0]:
+                        promoted = i
+        if promoted is not None:
+            level = promoted
+            self.stats[level].promoted += 1
+        put_at, item = queues[level].popleft()
+        self._count -= 1
+        stats = self.stats[level]
+        stats.depth -= 1
+        stats.served += 1
+        wait = now - put_at
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        return item
+    
+    def empty(self):
+        return not self._count
+    
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._count, timeout):
+                raise Empty()
+            return self._pop()
+    
+    def put(self, item, priority):
+        with self._cond:
+            self._queues[priority].append((time.perf_counter(), item))
+            self._count += 1
+            stats = self.stats[priority]
+            stats.depth += 1
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            self._cond.notify()
+    
+    def qsize(self):
+        return self._count
     
 
 class _ActualThread(threading.Thread):
     ''' We can't use this class directly because thread object are not automatically freed when
         nothing refers to it, making it hang the application if not explicitely closed.
     '''
-    def __init__(self, dbname, autocommit):
+    MAINTENANCE_TASKS = ['analyze', 'incremental_vacuum', 'wal_checkpoint']
+    # Pages freed by each slice of incremental vacuum
+    VACUUM_PAGES_PER_SLICE = 100
+    
+    def __init__(self, dbname, autocommit, init_queries=(), group_commit_window=0,
+            group_commit_size=100, metrics=None, max_queue_wait=1.0, maintenance_idle=None,
+            maintenance_interval=3600, table_tracker=None):
         threading.Thread.__init__(self)
-        self._queries = Queue()
-        self._results = Queue()
+        self._table_tracker = table_tracker
+        self._queries = _SchedulingQueue(max_queue_wait)
         self._dbname = dbname
         self._autocommit = autocommit
-        self._waiting_list = set()
+        self._init_queries = init_queries
+        self._group_commit_window = group_commit_window if autocommit else 0
+        self._group_commit_size = group_commit_size
+        self.metrics = metrics
+        self._maintenance_idle = maintenance_idle
+        self._maintenance_interval = maintenance_interval
+        self._last_activity = time.monotonic()
+        # time.monotonic() value at which each task is due again.
+        self._maintenance_due = {task: 0 for task in self.MAINTENANCE_TASKS}
+        # time.time() value at which each task was last completed, None if never.
+        self.maintenance_last_run = {task: None for task in self.MAINTENANCE_TASKS}
+        # Only held while a query is being put in the queue, never during the round-trip. Its job
+        # is to make sure that no query can end up in the queue after the thread stopped.
         self._lock = threading.Lock()
         self._run = True
+        self._pending = 0
+        self.in_transaction = False
+        # Cursors opened by stream(). Only accessed from the DB thread.
+        self._cursors = {}
+        # Blobs opened by blobopen(). Only accessed from the DB thread.
+        self._blobs = {}
+        self._cursor_ids = itertools.count()
         self.lastrowid = -1
         self.setDaemon(True)
         self.start()
     
-    def _query(self, query):
-        with self._lock:
-            wait_token = object()
-            self._waiting_list.add(wait_token)
-            self._queries.put(query)
-            self._waiting_list.remove(wait_token)
-            result = self._results.get()
+    def _query(self, query, priority=PRIORITY_NORMAL):
+        return self.submit_query(query, priority).result()
+    
+    def _process(self, con, query, enqueued_at):
+        if query is COMMIT:
+            con.commit()
+        elif query is ROLLBACK:
+            con.rollback()
+        elif callable(query):
+            return query(con)
+        else:
+            sql, values = query
+            if self.metrics is not None:
+                result = self._timed_execute(con, sql, values, enqueued_at)
+            else:
+                result = _execute(con, sql, values)
+            self.lastrowid = result.lastrowid
+            return result
+    
+    def _timed_execute(self, con, sql, values, enqueued_at):
+        metrics = self.metrics
+        started_at = time.perf_counter()
+        try:
+            cur = con.execute(sql, values)
+            executed_at = time.perf_counter()
+            result = FakeCursor(cur.fetchall())
+        except Exception:
+            metrics.record_error(sql)
+            raise
+        fetched_at = time.perf_counter()
+        result.lastrowid = cur.lastrowid
+        metrics.record_statement(
+            sql, started_at - enqueued_at, executed_at - started_at, fetched_at - executed_at,
+            len(result)
+        )
+        elapsed = fetched_at - started_at
+        if metrics.is_slow(elapsed) and metrics.on_slow_query is not None:
+            try:
+                metrics.on_slow_query(sql, elapsed, _explain(con, sql, values))
+            except Exception:
+                logging.exception("Error in slow query hook for %r", sql)
         return result
     
+    def _get(self, timeout=None):
+        item = self._queries.get(timeout=timeout)
+        if self.metrics is not None:
+            self.metrics.record_dequeue(self._queries.qsize())
+        return item
+    
+    def submit_query(self, query, priority=PRIORITY_NORMAL):
+        future = Future()
+        requested_at = time.perf_counter()
+        with self._lock:
+            enqueued_at = time.perf_counter()
+            if not self._run:
+                future.set_result(None) # Connection closed
+                return future
+            self._pending += 1
+            self._queries.put((query, future, enqueued_at), priority)
+        if self.metrics is not None:
+            self.metrics.record_enqueue(self._queries.qsize(), enqueued_at - requested_at)
+        return future
+    
     def close(self):
         if not self._run:
             return
-        self._query(STOP)
+        self._query(STOP, _PRIORITY_STOP)
     
     def commit(self):
-        if not self._run:
-            return None # Connection closed
         self._query(COMMIT)
     
-    def execute(self, sql, values=()):
-        if not self._run:
-            return None # Connection closed
-        result = self._query((sql, values))
-        if isinstance(result, Exception):
-            raise result
-        return result
+    def execute(self, sql, values=(), priority=PRIORITY_NORMAL):
+        return self._query((sql, values), priority)
+    
+    def submit_batch(self, queries, priority=PRIORITY_NORMAL):
+        queries = [(q[0], q[1] if len(q) > 1 else ()) for q in queries]
+        return self.submit_query(lambda con: _execute_batch(con, queries), priority)
+    
+    def submit_executemany(self, sql, seq_of_values, priority=PRIORITY_NORMAL):
+        seq_of_values = list(seq_of_values)
+        return self.submit_query(lambda con: _executemany(con, sql, seq_of_values), priority)
     
     def rollback(self):
-        if not self._run:
-            return None # Connection closed
         self._query(ROLLBACK)
     
-    def run(self):
-        # The whole chdir thing is because sqlite doesn't handle directory names with non-asci char in the AT ALL.
-        oldpath = os.getcwd()
-        dbdir, dbname = op.split(self._dbname)
-        if dbdir:
-            os.chdir(dbdir)
-        if self._autocommit:
-            con = sqlite.connect(dbname, isolation_level=None)
+    # The methods below are called on the DB thread, through a query callable.
+    def close_blob(self, blob_id):
+        blob = self._blobs.pop(blob_id, None)
+        if blob is not None:
+            blob.close()
+    
+    def close_cursor(self, cursor_id):
+        cur = self._cursors.pop(cursor_id, None)
+        if cur is not None:
+            cur.close()
+    
+    def fetch_chunk(self, cursor_id, size):
+        cur = self._cursors.get(cursor_id)
+        if cur is None:
+            return []
+        rows = cur.fetchmany(size)
+        if len(rows) < size:
+            self.close_cursor(cursor_id)
+        return rows
+    
+    def open_blob(self, con, table, column, row, readonly, name):
+        blob = con.blobopen(table, column, row, readonly=readonly, name=name)
+        blob_id = next(self._cursor_ids)
+        self._blobs[blob_id] = blob
+        return blob_id, len(blob)
+    
+    def open_cursor(self, con, sql, values, size):
+        cur = con.execute(sql, values)
+        cursor_id = next(self._cursor_ids)
+        self._cursors[cursor_id] = cur
+        rows = self.fetch_chunk(cursor_id, size)
+        if cursor_id not in self._cursors:
+            cursor_id = None
+        return cursor_id, cur.lastrowid, rows
+    
+    def _connect(self):
+        # The whole chdir thing is because sqlite doesn't handle directory names with non-asci char
+        # in the AT ALL. The current directory is process-wide, so connections are opened one at a
+        # time.
+        with _chdir_lock:
+            oldpath = os.getcwd()
+            dbdir, dbname = op.split(self._dbname)
+            if dbdir:
+                os.chdir(dbdir)
+            factory = sqlite.Connection if self._table_tracker is None else _TrackingConnection
+            try:
+                if self._autocommit:
+                    con = sqlite.connect(dbname, isolation_level=None, factory=factory)
+                else:
+                    con = sqlite.connect(dbname, factory=factory)
+            finally:
+                os.chdir(oldpath)
+        if self._table_tracker is not None:
+            con.tracker = self._table_tracker
+            con.set_authorizer(self._table_tracker.authorize)
+        for sql in self._init_queries:
+            try:
+                con.execute(sql)
+            except sqlite.Error as e:
+                logging.warning("Could not execute %r on %s: %s", sql, self._dbname, e)
+        return con
+    
+    def _handle(self, con, query, future, enqueued_at):
+        result = exception = None
+        running = future.set_running_or_notify_cancel()
+        if running:
+            try:
+                result = self._process(con, query, enqueued_at)
+            except BaseException as e:
+                # Callables passed to run_on_db_thread() can raise anything (SystemExit, for
+                # example). It's the caller's problem, the DB thread must stay alive.
+                exception = e
+        # Our state has to be up to date by the time the caller gets its result.
+        self.in_transaction = con.in_transaction
+        with self._lock:
+            self._pending -= 1
+        if not running:
+            return
+        if exception is not None:
+            future.set_exception(exception)
         else:
-            con = sqlite.connect(dbname)
-        os.chdir(oldpath)
-        while self._run or self._waiting_list:
-            query = self._queries.get()
-            result = None
+            future.set_result(result)
+    
+    def is_idle(self):
+        """Returns whether there are no queries queued or running and no transaction pending."""
+        return not self._pending and not self.in_transaction
+    
+    def serve_pending(self, con):
+        # Executes the queries that are currently queued. Used to serve queries during a
+        # long-running query. Queries that can't be executed in the middle of another one are put
+        # back in the queue.
+        for i in range(self._queries.qsize()):
+            try:
+                query, future, enqueued_at = self._get(timeout=0)
+            except Empty:
+                break
             if query is STOP:
-                self._run = False
-            elif query is COMMIT:
-                con.commit()
-            elif query is ROLLBACK:
-                con.rollback()
+                self._queries.put((query, future, enqueued_at), _PRIORITY_STOP)
+            elif isinstance(query, _Backup):
+                self._queries.put((query, future, enqueued_at), PRIORITY_LOW)
+            else:
+                self._handle(con, query, future, enqueued_at)
+    
+    def _maintenance_timeout(self):
+        # Time until the next maintenance slice is due, given that no query comes in.
+        next_due = min(self._maintenance_due.values())
+        start = max(next_due, self._last_activity + self._maintenance_idle)
+        return max(start - time.monotonic(), 0)
+    
+    def _maintain(self, con):
+        # Runs a slice of the most overdue maintenance task, if any.
+        now = time.monotonic()
+        task = min(self._maintenance_due, key=self._maintenance_due.get)
+        if self._maintenance_due[task] > now:
+            return
+        if con.in_transaction:
+            # Maintenance would become part of the pending transaction. Wait for another idle
+            # period instead.
+            self._last_activity = now
+            return
+        try:
+            done = getattr(self, '_maintain_' + task)(con)
+        except sqlite.Error as e:
+            logging.warning("Maintenance task %s failed on %s: %s", task, self._dbname, e)
+            done = True
+        except Exception:
+            # A bug in a maintenance task must not kill the DB thread.
+            logging.exception("Maintenance task %s failed on %s", task, self._dbname)
+            done = True
+        if done:
+            self._maintenance_due[task] = time.monotonic() + self._maintenance_interval
+            self.maintenance_last_run[task] = time.time()
+    
+    def _maintain_analyze(self, con):
+        # analysis_limit makes ANALYZE only look at a sample of each index, bounding its duration.
+        # It's restored afterwards: the application's own ANALYZEs shouldn't be sampled.
+        row = con.execute('PRAGMA analysis_limit').fetchone()
+        if row is None: # SQLite < 3.32, no analysis_limit
+            con.execute('ANALYZE')
+            return True
+        con.execute('PRAGMA analysis_limit = 1000')
+        try:
+            con.execute('ANALYZE')
+        finally:
+            con.execute('PRAGMA analysis_limit = {:d}'.format(row[0]))
+        return True
+    
+    def _maintain_incremental_vacuum(self, con):
+        if con.execute('PRAGMA auto_vacuum').fetchone()[0] != 2: # not INCREMENTAL
+            return True
+        # Pages are only freed as the pragma's results are fetched.
+        con.execute('PRAGMA incremental_vacuum({})'.format(self.VACUUM_PAGES_PER_SLICE)).fetchall()
+        return con.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    
+    def _maintain_wal_checkpoint(self, con):
+        if con.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # PASSIVE never waits on readers or writers
+            con.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+        return True
+    
+    def _can_group(self, query):
+        return isinstance(query, tuple) and bool(RE_DML.match(query[0]))
+    
+    def _group_commit(self, con, query, future, enqueued_at):
+        # Executes ``query`` and the DML queries following it, up to the group commit window or
+        # size, in a single transaction. Callers only get their result once that transaction is
+        # committed. Returns the first queued item that couldn't be part of the group, if any.
+        deadline = time.monotonic() + self._group_commit_window
+        con.execute('BEGIN')
+        group = []
+        next_item = None
+        while True:
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._pending -= 1
             else:
-                sql, values = query
                 try:
-                    cur = con.execute(sql, values)
-                    self.lastrowid = cur.lastrowid
-                    result = FakeCursor(cur.fetchall())
-                    result.lastrowid = cur.lastrowid
+                    group.append((future, self._process(con, query, enqueued_at)))
                 except Exception as e:
-                    result = e
-            self._results.put(result)
+                    if not con.in_transaction:
+                        # Some errors roll the whole transaction back, taking the group with it.
+                        self._finish_group(group, con, e)
+                        group = []
+                        con.execute('BEGIN')
+                    self._finish_group([(future, e)], con)
+            timeout = deadline - time.monotonic()
+            if len(group) >= self._group_commit_size or timeout <= 0:
+                break
+            try:
+                query, future, enqueued_at = self._get(timeout=timeout)
+            except Empty:
+                break
+            if not self._can_group(query):
+                next_item = (query, future, enqueued_at)
+                break
+        try:
+            con.execute('COMMIT')
+        except Exception as e:
+            if con.in_transaction:
+                con.rollback()
+            self._finish_group(group, con, e)
+        else:
+            self._finish_group(group, con)
+        return next_item
+    
+    def _finish_group(self, group, con, exception=None):
+        self.in_transaction = con.in_transaction
+        with self._lock:
+            self._pending -= len(group)
+        for future, result in group:
+            if exception is not None:
+                future.set_exception(exception)
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    def run(self):
+        con = self._connect()
+        next_item = None
+        while True:
+            if next_item is not None:
+                query, future, enqueued_at = next_item
+                next_item = None
+            elif self._maintenance_idle is not None:
+                try:
+                    query, future, enqueued_at = self._get(timeout=self._maintenance_timeout())
+                except Empty:
+                    self._maintain(con)
+                    continue
+            else:
+                query, future, enqueued_at = self._get()
+            if query is STOP:
+                with self._lock:
+                    self._run = False
+                future.set_result(None)
+                break
+            if self._group_commit_window and not con.in_transaction and self._can_group(query):
+                next_item = self._group_commit(con, query, future, enqueued_at)
+            else:
+                self._handle(con, query, future, enqueued_at)
+            self._last_activity = time.monotonic()
+        for cur in self._cursors.values():
+            cur.close()
+        self._cursors.clear()
+        for blob in self._blobs.values():
+            blob.close()
+        self._blobs.clear()
         con.close()
+        # Queries that were queued after STOP are answered like queries made after close().
+        while not self._queries.empty():
+            query, future, enqueued_at = self._queries.get()
+            if future.set_running_or_notify_cancel():
+                future.set_result(None)
     
 
 class ThreadedConn:
     """``sqlite`` connections can't be used across threads. ``TheadedConn`` opens a sqlite
     connection in its own thread and sends it queries through a queue, making it suitable in
     multi-threaded environment.
+    
+    In ``autocommit`` mode, each write is its own transaction, which costs a disk sync each time.
+    With a non-zero ``group_commit_window`` (in seconds), INSERT, UPDATE, DELETE and REPLACE
+    statements reaching the DB thread within that window, up to ``group_commit_size`` of them,
+    share a single transaction. Their callers get their result only once that transaction is
+    committed. This only helps when writes come concurrently (through :meth:`submit` or from
+    several threads) because each blocking :meth:`execute` waits for the window to end.
+    
+    To collect query timings, pass a :class:`QueryMetrics` instance as ``metrics``. It's then
+    available through the ``metrics`` attribute.
+    
+    With a non-zero ``cache_size``, the results of read-only statements sent through
+    :meth:`execute` are kept in a :class:`ResultCache` of that many entries (and of at most
+    ``cache_memory`` bytes, if set), available through the ``cache`` attribute. Repeated queries
+    are then answered without going through the DB thread. Writes made through this connection
+    invalidate the cache, but writes made by other connections to the same database don't.
+    
+    ``profile`` is the name of a tuning profile in ``PROFILES`` ("bulk-load", "interactive" or
+    "durable"), setting pragmas like the page cache size or the journal mode when the connection
+    is opened. It can be changed later with :meth:`set_profile`.
+    
+    Queries can be given a ``priority``: ``PRIORITY_HIGH`` queries are executed before queued
+    ``PRIORITY_NORMAL`` ones, which are executed before ``PRIORITY_LOW`` ones. A query waiting for
+    more than ``max_queue_wait`` seconds is executed before queries of higher priority. Queries of
+    different priorities can thus be executed in another order than the one they were submitted
+    in. Per-priority queue statistics are available through :meth:`queue_stats`.
+    
+    With ``maintenance_idle`` set, the DB thread runs maintenance tasks (ANALYZE, incremental
+    vacuum and WAL checkpoints) when no query has come in for that many seconds. Tasks are run in
+    small slices, checking for new queries in between, and each task is run at most once every
+    ``maintenance_interval`` seconds. :attr:`maintenance_last_run` tells when they last ran.
+    Incremental vacuum only does something on databases created with ``auto_vacuum`` set to
+    ``INCREMENTAL``.
     """
-    def __init__(self, dbname, autocommit):
-        self._t = _ActualThread(dbname, autocommit)
+    def __init__(self, dbname, autocommit, group_commit_window=0, group_commit_size=100,
+            metrics=None, cache_size=0, cache_memory=None, max_queue_wait=1.0, profile=None,
+            maintenance_idle=None, maintenance_interval=3600):
+        init_queries = profile_queries(profile) if profile else ()
+        self.profile = profile
+        self.cache = ResultCache(cache_size, cache_memory) if cache_size else None
+        self._table_tracker = _TableTracker() if cache_size else None
+        self._t = _ActualThread(
+            dbname, autocommit, init_queries, group_commit_window=group_commit_window,
+            group_commit_size=group_commit_size, metrics=metrics, max_queue_wait=max_queue_wait,
+            maintenance_idle=maintenance_idle, maintenance_interval=maintenance_interval,
+            table_tracker=self._table_tracker,
+        )
+        self.metrics = metrics
         self.lastrowid = -1
     
     def __del__(self):
-        self.close()
+        if hasattr(self, '_t'): # __init__() could have failed
+            self.close()
+    
+    def _thread_for(self, sql):
+        return self._t
+    
+    def _cached_execute(self, sql, values, priority):
+        cache = self.cache
+        key = _cache_key(sql, values)
+        if key is None:
+            return self._uncached_execute(sql, values, priority)
+        result = cache.get(key)
+        if result is not None:
+            # Nothing was executed: lastrowid is the one the statement would have left.
+            result.lastrowid = self.lastrowid
+            return result
+        generation = cache.generation
+        result = self._uncached_execute(sql, values, priority)
+        if result is not None:
+            cache.put(key, self._table_tracker.read_by(sql), result, generation)
+        return result
+    
+    def _submit_batch(self, queries, priority):
+        # Returns a future for execute_batch() invalidating the cache when it's done.
+        queries = list(queries)
+        future = self._t.submit_batch(queries, priority)
+        if self.cache is not None:
+            def invalidate(f):
+                for query in queries:
+                    self._invalidate(query[0])
+            
+            future.add_done_callback(invalidate)
+        return future
+    
+    def _submit_executemany(self, sql, seq_of_values, priority):
+        # Returns a future for executemany() invalidating the cache when it's done.
+        future = self._t.submit_executemany(sql, seq_of_values, priority)
+        if self.cache is not None:
+            future.add_done_callback(lambda f: self._invalidate(sql))
+        return future
+    
+    def _uncached_execute(self, sql, values, priority):
+        result = self._thread_for(sql).execute(sql, values, priority)
+        if result is not None:
+            self.lastrowid = result.lastrowid
+        return result
+    
+    def _end_transaction(self, query):
+        # Returns a future for ``query`` (COMMIT or ROLLBACK) ending the cache's transaction when
+        # it's done. For AsyncThreadedConn: the synchronous methods can't rely on done callbacks
+        # because Future.result() can return before they have run.
+        future = self._t.submit_query(query)
+        if self.cache is not None:
+            future.add_done_callback(lambda f: self.cache.end_transaction())
+        return future
+    
+    def _invalidate(self, sql):
+        # Call *after* the statement has been executed: A read sent before the write that
+        # completes after it has to be prevented from being cached.
+        if self.cache is not None and not is_readonly(sql):
+            self.cache.invalidate_writes(self._table_tracker.written_by(sql))
+    
+    def backup(self, dest_path, pages_per_step=100, j=nulljob):
+        """Copies the database to ``dest_path`` while it stays in use.
+        
+        Returns immediately with a :class:`concurrent.futures.Future` which is done when the copy
+        is. The copy is made on the DB thread with sqlite's backup API, ``pages_per_step`` pages at
+        a time, executing the queries queued in the meantime after each step. Queries are thus
+        never blocked for more than a step. Progress is reported through ``j``, a
+        :class:`.jobprogress.job.Job`, from the DB thread. If the job is cancelled, the backup is
+        aborted and the future holds :class:`.jobprogress.job.JobCancelled`.
+        """
+        query = _Backup(self._t, str(dest_path), pages_per_step, j)
+        return self._t.submit_query(query, PRIORITY_LOW)
+    
+    def blobopen(self, table, column, row, readonly=True, name='main', chunksize=64*1024):
+        """Opens the BLOB in ``column`` of ``table`` at rowid ``row`` and returns a
+        :class:`BlobHandle` on it.
+        
+        Blobs are read and written ``chunksize`` bytes at a time, without loading them whole in
+        memory. Returns ``None`` if the connection is closed. Requires Python 3.11.
+        """
+        t = self._t
+        result = t._query(lambda con: t.open_blob(con, table, column, row, readonly, name))
+        if result is None:
+            return None
+        on_write = None
+        if not readonly and self.cache is not None:
+            # Invalidated at each write: results could be cached between the opening and a write.
+            tables = [_table_key(name, table)]
+            on_write = lambda: self.cache.invalidate_writes(tables)
+        blob_id, length = result
+        return BlobHandle(t, blob_id, length, chunksize, on_write)
     
     def close(self):
         self._t.close()
     
     def commit(self):
-        self._t.commit()
+        try:
+            self._t.commit()
+        finally:
+            if self.cache is not None:
+                self.cache.end_transaction()
+    
+    def execute(self, sql, values=(), priority=PRIORITY_NORMAL):
+        if self.cache is not None and is_readonly(sql):
+            return self._cached_execute(sql, values, priority)
+        try:
+            return self._uncached_execute(sql, values, priority)
+        finally:
+            self._invalidate(sql)
     
-    def execute(self, sql, values=()):
-        result = self._t.execute(sql, values)
-        self.lastrowid = self._t.lastrowid
+    def executemany(self, sql, seq_of_values, priority=PRIORITY_NORMAL):
+        """Executes ``sql`` once for each item of ``seq_of_values`` in a single trip to the
+        DB thread.
+        
+        Returns an empty result with ``rowcount`` and ``lastrowid`` attributes.
+        """
+        try:
+            result = self._t.submit_executemany(sql, seq_of_values, priority).result()
+        finally:
+            self._invalidate(sql)
+        if result is not None:
+            self.lastrowid = result.lastrowid
         return result
     
+    def execute_batch(self, queries, priority=PRIORITY_NORMAL):
+        """Executes a list of ``(sql, values)`` queries in a single trip to the DB thread.
+        
+        Returns a list containing the result of each query, in order. If a query fails, its
+        exception is raised and the queries following it aren't executed.
+        """
+        queries = list(queries)
+        try:
+            result = self._t.submit_batch(queries, priority).result()
+        finally:
+            for query in queries:
+                self._invalidate(query[0])
+        if result:
+            self.lastrowid = result[-1].lastrowid
+        return result
+    
+    def rollback(self):
+        try:
+            self._t.rollback()
+        finally:
+            if self.cache is not None:
+                self.cache.end_transaction()
+    
+    def run_on_db_thread(self, func, priority=PRIORITY_NORMAL):
+        """Calls ``func(con)`` on the DB thread and returns its result.
+        
+        ``con`` is the underlying ``sqlite3`` connection. It must not be kept around or used after
+        ``func`` returns. Nothing else is executed on the connection while ``func`` runs. If a
+        result cache is used, it's cleared because we can't know what ``func`` has written.
+        """
+        try:
+            return self._t._query(func, priority)
+        finally:
+            if self.cache is not None:
+                self.cache.clear()
+    
+    def set_profile(self, profile):
+        """Applies the pragmas of ``profile``, a key of ``PROFILES``.
+        
+        Some pragmas, such as ``journal_mode``, can't be changed while a transaction is pending.
+        """
+        queries = profile_queries(profile)
+        self._t._query(lambda con: _execute_batch(con, [(sql, ()) for sql in queries]))
+        self.profile = profile
+    
+    def stream(self, sql, values=(), chunksize=1000):
+        """Executes ``sql`` and returns a :class:`StreamingCursor` on its results.
+        
+        Unlike :meth:`execute`, results aren't all fetched at once. They're fetched from the DB
+        thread ``chunksize`` rows at a time, as they're consumed, which keeps memory usage bounded
+        for big result sets. Returns ``None`` if the connection is closed.
+        """
+        t = self._thread_for(sql)
+        try:
+            result = t._query(lambda con: t.open_cursor(con, sql, values, chunksize))
+        finally:
+            self._invalidate(sql)
+        if result is None:
+            return None
+        cursor_id, lastrowid, rows = result
+        self.lastrowid = lastrowid
+        return StreamingCursor(t, cursor_id, rows, chunksize)
+    
+    def execute_columnar(self, sql, values=(), use_numpy=True, chunksize=10000,
+            priority=PRIORITY_NORMAL):
+        """Executes ``sql`` and returns its results by column.
+        
+        Returns a dict mapping column names to their values, built on the DB thread ``chunksize``
+        rows at a time. Columns holding only integers are ``array('q')``, columns holding only
+        numbers are ``array('d')`` and other columns (holding strings or NULLs, for example) are
+        lists. If ``use_numpy`` is true and NumPy is available, arrays are converted (without copy)
+        to NumPy ``int64`` and ``float64`` arrays. Returns ``None`` if the connection is closed.
+        """
+        t = self._thread_for(sql)
+        try:
+            return t._query(
+                lambda con: _execute_columnar(con, sql, values, use_numpy, chunksize), priority
+            )
+        finally:
+            self._invalidate(sql)
+    
+    @property
+    def maintenance_last_run(self):
+        """Dict of the ``time.time()`` at which each maintenance task last completed.
+        
+        Values are ``None`` for tasks that haven't run yet.
+        """
+        return dict(self._t.maintenance_last_run)
+    
+    def queue_stats(self):
+        """Returns a list of :class:`PriorityQueueStats`, indexed by priority."""
+        return self._t._queries.stats[:_PRIORITY_STOP]
+    
+    def transaction(self, unit, priority=PRIORITY_NORMAL):
+        """Executes ``unit`` in a single transaction, in a single trip to the DB thread.
+        
+        ``unit`` is either a list of ``(sql, values)`` queries, in which case a list of their
+        results is returned, or a callable, which is called with the underlying ``sqlite3``
+        connection and whose result is returned (see :meth:`run_on_db_thread`).
+        
+        The transaction is committed if ``unit`` succeeds and rolled back if it raises an
+        exception, which is then re-raised. Queries from other threads can't be executed in the
+        middle of it. If a transaction is already pending on the connection (``autocommit`` is
+        ``False``), ``unit`` is executed in a savepoint instead: it's rolled back on failure, but
+        on success, its changes are only committed with the pending transaction.
+        """
+        if not callable(unit):
+            unit = [(q[0], q[1] if len(q) > 1 else ()) for q in unit]
+        return self.run_on_db_thread(lambda con: _run_transaction(con, unit), priority)
+    
+    def submit(self, sql, values=(), priority=PRIORITY_NORMAL):
+        """Queues ``sql`` for execution and returns immediately.
+        
+        Returns a :class:`concurrent.futures.Future` which will hold the query's result (or its
+        exception) once the DB thread has executed it. Queries of the same priority submitted from
+        the same thread are executed in the order they were submitted. Unlike :meth:`execute`,
+        this doesn't update ``lastrowid``, use the result's ``lastrowid`` instead.
+        """
+        future = self._thread_for(sql).submit_query((sql, values), priority)
+        if self.cache is not None and not is_readonly(sql):
+            future.add_done_callback(lambda f: self._invalidate(sql))
+        return future
+    
+
+class PooledConn(ThreadedConn):
+    """A :class:`ThreadedConn` with a pool of reader threads.
+    
+    The database is put in WAL mode, which lets readers run concurrently with the writer. Writes
+    go through a single writer thread, like with :class:`ThreadedConn`. Read-only statements (see
+    :func:`is_readonly`) are sent to the least busy of ``readers`` reader threads, each having its
+    own connection, so a long SELECT doesn't block writes or other reads.
+    
+    Reads go to the writer thread when it has queries pending or a transaction open, so that they
+    always see the connection's own writes. WAL mode doesn't work with ``:memory:`` databases.
+    """
+    def __init__(self, dbname, autocommit, readers=2, **kwargs):
+        if dbname == ':memory:':
+            raise ValueError("A PooledConn can't be used with an in-memory database")
+        ThreadedConn.__init__(self, dbname, autocommit, **kwargs)
+        # Readers can't open the database before it's switched to WAL mode. This overrides the
+        # journal mode of the profile, if any.
+        self._t.execute('PRAGMA journal_mode = WAL')
+        init_queries = ['PRAGMA query_only = ON']
+        if self.profile:
+            init_queries += profile_queries(self.profile, exclude={'journal_mode'})
+        self._readers = [
+            _ActualThread(
+                dbname, True, init_queries, metrics=self.metrics,
+                table_tracker=self._table_tracker
+            )
+            for i in range(readers)
+        ]
+    
+    def _thread_for(self, sql):
+        if not self._readers or not is_readonly(sql) or not self._t.is_idle():
+            return self._t
+        return min(self._readers, key=lambda t: t._pending)
+    
+    def close(self):
+        for t in getattr(self, '_readers', []):
+            t.close()
+        ThreadedConn.close(self)
+    
+    def set_profile(self, profile):
+        # The journal mode has to stay WAL
+        queries = [(sql, ()) for sql in profile_queries(profile, exclude={'journal_mode'})]
+        for t in [self._t] + self._readers:
+            t._query(lambda con: _execute_batch(con, queries))
+        self.profile = profile
+    
+
+
+def _wait_all(futures):
+    # Waits for all futures to be done, then raises the first exception, if any.
+    results = []
+    exception = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            if exception is None:
+                exception = e
+    if exception is not None:
+        raise exception
+    return results
+
+def default_route(key, shard_count):
+    """Returns the index of the shard ``key`` goes in.
+    
+    Integers are distributed by modulo, other keys by a CRC32 of their ``str()``, which, unlike
+    ``hash()``, stays the same across runs.
+    """
+    if isinstance(key, int):
+        return key % shard_count
+    return zlib.crc32(str(key).encode('utf-8')) % shard_count
+
+class ShardedConn:
+    """Spreads a database across several files, each having its own :class:`ThreadedConn`.
+    
+    Rows are assigned to shards by key: ``route(key, shard_count)`` returns the index, in
+    ``dbnames``, of the shard holding ``key``. The default is :func:`default_route`. Every shard
+    must have the same schema. Each shard has its own DB thread, so writes to different shards are
+    executed in parallel. Other arguments are passed to each shard's ``ThreadedConn``.
+    
+    There's no transaction spanning shards: :meth:`commit` commits each shard independently.
+    """
+    def __init__(self, dbnames, autocommit, route=default_route, **kwargs):
+        self.shards = [ThreadedConn(dbname, autocommit, **kwargs) for dbname in dbnames]
+        self._route = route
+    
+    def __len__(self):
+        return len(self.shards)
+    
+    def set_profile(self, profile):
+        """Applies ``profile`` to all shards."""
+        for shard in self.shards:
+            shard.set_profile(profile)
+    
+    def _end_transactions(self, query):
+        try:
+            _wait_all([shard._t.submit_query(query) for shard in self.shards])
+        finally:
+            for shard in self.shards:
+                if shard.cache is not None:
+                    shard.cache.end_transaction()
+    
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+    
+    def commit(self):
+        """Commits all shards in parallel."""
+        self._end_transactions(COMMIT)
+    
+    def execute(self, key, sql, values=(), priority=PRIORITY_NORMAL):
+        """Executes ``sql`` on the shard holding ``key``."""
+        return self.shard_for(key).execute(sql, values, priority)
+    
+    def execute_all(self, sql, values=(), order_key=None, priority=PRIORITY_NORMAL):
+        """Executes ``sql`` on all shards in parallel and returns their merged results.
+        
+        Results are concatenated in shard order. If ``order_key`` is given, each shard's results
+        are assumed to be sorted by it (with an ``ORDER BY`` clause) and they're merged in that
+        order instead. Aggregates (``count()``, ``sum()``, ...) are returned by shard and have to
+        be combined by the caller.
+        """
+        results = _wait_all([shard.submit(sql, values, priority) for shard in self.shards])
+        results = [r for r in results if r is not None]
+        if order_key is not None:
+            return FakeCursor(heapq.merge(*results, key=order_key))
+        return FakeCursor(itertools.chain.from_iterable(results))
+    
+    def executemany(self, key_func, sql, seq_of_values, priority=PRIORITY_NORMAL):
+        """Executes ``sql`` for each item of ``seq_of_values`` on the shard holding
+        ``key_func(values)``.
+        
+        Items are grouped by shard, and each shard gets its items in a single executemany, all
+        shards working in parallel. Returns the total number of modified rows.
+        """
+        by_shard = defaultdict(list)
+        for values in seq_of_values:
+            by_shard[self._route(key_func(values), len(self.shards))].append(values)
+        futures = [
+            (self.shards[index], self.shards[index]._t.submit_executemany(sql, rows, priority))
+            for index, rows in by_shard.items()
+        ]
+        try:
+            results = _wait_all([future for shard, future in futures])
+        finally:
+            for shard, future in futures:
+                shard._invalidate(sql)
+        return sum(r.rowcount for r in results if r is not None)
+    
     def rollback(self):
-        self._t.rollback()
+        """Rolls back all shards in parallel."""
+        self._end_transactions(ROLLBACK)
+    
+    def shard_for(self, key):
+        """Returns the :class:`ThreadedConn` of the shard holding ``key``."""
+        return self.shards[self._route(key, len(self.shards))]
+    
+    def submit(self, key, sql, values=(), priority=PRIORITY_NORMAL):
+        """Same as :meth:`ThreadedConn.submit`, on the shard holding ``key``."""
+        return self.shard_for(key).submit(sql, values, priority)
+    
+
+def _copy_future_state(source, dest):
+    # Called on the event loop's thread
+    if dest.cancelled():
+        return
+    exception = source.exception()
+    if exception is not None:
+        dest.set_exception(exception)
+    else:
+        dest.set_result(source.result())
+
+class AsyncThreadedConn:
+    """An asyncio front-end to :class:`ThreadedConn`.
+    
+    Methods are coroutines. Queries are queued to the DB thread without blocking and the DB thread
+    wakes the event loop up through ``call_soon_threadsafe()`` when they're done, so any number of
+    coroutines can share the connection without stalling the loop. Must be used from a running
+    event loop. With a result cache, cached reads return without a trip to the DB thread.
+    """
+    def __init__(self, dbname, autocommit, **kwargs):
+        self._conn = ThreadedConn(dbname, autocommit, **kwargs)
+        self.lastrowid = -1
+    
+    def _wrap(self, future):
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(_copy_future_state, f, result)
+        )
+        return result
+    
+    async def close(self):
+        await self._wrap(self._conn._t.submit_query(STOP, _PRIORITY_STOP))
+    
+    @property
+    def cache(self):
+        return self._conn.cache
+    
+    async def commit(self):
+        await self._wrap(self._conn._end_transaction(COMMIT))
+    
+    async def execute(self, sql, values=(), priority=PRIORITY_NORMAL):
+        cache = self._conn.cache
+        key = _cache_key(sql, values) if cache is not None and is_readonly(sql) else None
+        if key is not None:
+            result = cache.get(key)
+            if result is not None:
+                result.lastrowid = self.lastrowid
+                return result
+            generation = cache.generation
+        result = await self._wrap(self._conn.submit(sql, values, priority))
+        if result is not None:
+            self.lastrowid = result.lastrowid
+            if key is not None:
+                cache.put(key, self._conn._table_tracker.read_by(sql), result, generation)
+        return result
+    
+    async def executemany(self, sql, seq_of_values, priority=PRIORITY_NORMAL):
+        result = await self._wrap(self._conn._submit_executemany(sql, seq_of_values, priority))
+        if result is not None:
+            self.lastrowid = result.lastrowid
+        return result
+    
+    async def execute_batch(self, queries, priority=PRIORITY_NORMAL):
+        result = await self._wrap(self._conn._submit_batch(queries, priority))
+        if result:
+            self.lastrowid = result[-1].lastrowid
+        return result
+    
+    async def rollback(self):
+        await self._wrap(self._conn._end_transaction(ROLLBACK))
     
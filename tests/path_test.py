@@ -6,12 +6,18 @@
 # which should be included with this package. The terms are also available at 
 # http://www.gnu.org/licenses/gpl-3.0.html
 
-import sys
+import errno
 import os
+import shutil
+import sys
 
 from pytest import raises, mark
 
-from ..path import Path, pathify
+from ..jobprogress.job import Job, JobCancelled
+from .. import path as pathmod
+from ..path import (
+    Path, PathSet, PathStore, ScannedPath, copy_file, copy_many, pathify, stat_many
+)
 from ..testutil import eq_
 
 def pytest_funcarg__force_ossep(request):
@@ -254,3 +260,418 @@ def test_pathify_preserve_none():
     
     a = foo(None)
     assert a is None
+
+def test_parsing_is_cached(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    p1 = Path('/foo/bar')
+    p2 = Path('/foo/bar')
+    assert p1 is p2
+    # The separator is part of the cache key
+    eq_(Path('foo:bar', ':'), ('foo', 'bar'))
+    eq_(Path('foo:bar', '/'), ('foo:bar', ))
+
+def test_compare_with_tuple_and_str(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    p = Path('foo/bar')
+    assert p == ('foo', 'bar')
+    assert p != ('foo', 'baz')
+    # A tuple that isn't equal element-wise can still be equal once converted to a Path.
+    assert p == ('foo/bar', )
+    assert p == ['foo', 'bar']
+    assert p == 'foo/bar'
+    assert p != Path('foo')
+    assert not (p != Path('foo/bar'))
+
+def test_pathstore_add_and_get(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    store = PathStore()
+    h1 = store.add('/foo/bar/baz')
+    h2 = store.add(Path('/foo/bar/qux'))
+    eq_(store[h1], Path('/foo/bar/baz'))
+    assert isinstance(store[h2], Path)
+    eq_(store[h2], Path('/foo/bar/qux'))
+    # Parents are shared
+    eq_(store.parent(h1), store.parent(h2))
+    eq_(store[store.parent(h1)], Path('/foo/bar'))
+    eq_(store.name(h1), 'baz')
+    eq_(len(store), 5) # '', foo, bar, baz, qux
+    eq_(store.add('/foo/bar/baz'), h1)
+    eq_(len(store), 5)
+
+def test_pathstore_find(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    store = PathStore()
+    h = store.add('/foo/bar')
+    eq_(store.find('/foo/bar'), h)
+    assert store.find('/foo/baz') is None
+    assert '/foo' in store
+    assert Path('/foo/bar') in store
+    assert 'foo' not in store
+    eq_(store.find(''), PathStore.ROOT)
+    eq_(store[PathStore.ROOT], Path(''))
+
+def test_pathstore_interns_names(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    store = PathStore()
+    # Build the names dynamically so that they're not the same object to begin with.
+    h1 = store.add(('a', ''.join(['na', 'me'])))
+    h2 = store.add(('b', ''.join(['na', 'me'])))
+    assert store.name(h1) is store.name(h2)
+
+def test_scandir(tmpdir, monkeypatch):
+    tmpdir.mkdir('dir')
+    tmpdir.join('file').write('foobar')
+    p = Path(str(tmpdir))
+    result = sorted(p.scandir())
+    eq_(result, [p['dir'], p['file']])
+    dirpath, filepath = result
+    assert isinstance(dirpath, ScannedPath)
+    # Type and stat queries don't go through the filesystem anymore
+    monkeypatch.setattr(os, 'stat', None)
+    monkeypatch.setattr(os.path, 'isdir', None)
+    assert dirpath.isdir()
+    assert not dirpath.isfile()
+    assert filepath.isfile()
+    assert not filepath.islink()
+    eq_(filepath.stat().st_size, 6)
+    # Derived paths are regular paths
+    assert type(filepath.parent()) is Path
+    assert type(dirpath['foo']) is Path
+
+def test_listdir_with_stat(tmpdir):
+    tmpdir.join('file').write('foobar')
+    p = Path(str(tmpdir))
+    [filepath] = p.listdir()
+    assert type(filepath) is Path
+    [filepath] = p.listdir(with_stat=True)
+    assert isinstance(filepath, ScannedPath)
+    tmpdir.join('file').remove()
+    # The stat info was fetched during listdir()
+    eq_(filepath.stat().st_size, 6)
+
+def test_scannedpath_pickles_as_path(tmpdir):
+    import pickle
+    tmpdir.join('file').write('')
+    [filepath] = Path(str(tmpdir)).scandir()
+    unpickled = pickle.loads(pickle.dumps(filepath))
+    assert type(unpickled) is Path
+    eq_(unpickled, filepath)
+
+def make_tree(tmpdir):
+    # root/a/b/c/file3, root/a/file2, root/file1, root/x/y
+    tmpdir.join('file1').write('')
+    tmpdir.mkdir('a').join('file2').write('')
+    tmpdir.join('a').mkdir('b').mkdir('c').join('file3').write('')
+    tmpdir.mkdir('x').mkdir('y')
+    return Path(str(tmpdir))
+
+def walked(root, **kwargs):
+    return sorted(p[root:] for p in root.walk(**kwargs))
+
+def test_walk(tmpdir):
+    root = make_tree(tmpdir)
+    result = list(root.walk(workers=2))
+    assert all(isinstance(p, ScannedPath) for p in result)
+    eq_(sorted(p[root:] for p in result), [
+        ('a', ), ('a', 'b'), ('a', 'b', 'c'), ('a', 'b', 'c', 'file3'), ('a', 'file2'), ('file1', ),
+        ('x', ), ('x', 'y'),
+    ])
+
+def test_walk_include_exclude(tmpdir):
+    root = make_tree(tmpdir)
+    # include doesn't prevent walking into directories
+    eq_(walked(root, include=lambda p: p.isfile()), [
+        ('a', 'b', 'c', 'file3'), ('a', 'file2'), ('file1', ),
+    ])
+    # exclude does
+    eq_(walked(root, exclude=lambda p: p.name in {'b', 'x'}), [
+        ('a', ), ('a', 'file2'), ('file1', ),
+    ])
+
+def test_walk_max_depth(tmpdir):
+    root = make_tree(tmpdir)
+    eq_(walked(root, max_depth=1), [('a', ), ('file1', ), ('x', )])
+    eq_(walked(root, max_depth=2), [
+        ('a', ), ('a', 'b'), ('a', 'file2'), ('file1', ), ('x', ), ('x', 'y'),
+    ])
+
+def test_walk_doesnt_follow_symlinks_by_default(tmpdir):
+    root = make_tree(tmpdir)
+    os.symlink(str(root['a']), str(root['x']['link']))
+    eq_(walked(root, include=lambda p: p.name == 'file2'), [('a', 'file2')])
+    result = walked(root, include=lambda p: p.name == 'file2', follow_symlinks=True)
+    eq_(result, [('a', 'file2'), ('x', 'link', 'file2')])
+
+def test_walk_unreadable_directory_is_skipped(tmpdir, monkeypatch):
+    root = make_tree(tmpdir)
+    old_scandir = Path.scandir
+    def scandir(self):
+        if self.name == 'a':
+            raise PermissionError("denied")
+        return old_scandir(self)
+    monkeypatch.setattr(Path, 'scandir', scandir)
+    eq_(walked(root), [('a', ), ('file1', ), ('x', ), ('x', 'y')])
+
+def test_walk_progress_and_cancel(tmpdir):
+    root = make_tree(tmpdir)
+    progress = []
+    def callback(p, desc=''):
+        progress.append((p, desc))
+        return True
+    list(root.walk(j=Job(1, callback)))
+    eq_(progress[-1], (100, "Scanned 6/6 folders"))
+    gen = root.walk(j=Job(1, lambda p, desc='': p < 0))
+    with raises(JobCancelled):
+        list(gen)
+
+def test_stat_many(tmpdir):
+    root = make_tree(tmpdir)
+    root['file1'].open('w').write('foo')
+    paths = [root['file1'], str(root['a']), root['missing'], root['a']['file2']]
+    result = stat_many(paths, workers=2, chunk_size=1)
+    eq_(len(result), 4)
+    eq_(list(result.failed), [0, 0, 1, 0])
+    eq_(list(result.errors), [2])
+    assert isinstance(result.errors[2], FileNotFoundError)
+    eq_(result.sizes[0], 3)
+    eq_(result.sizes[2], 0)
+    st = os.stat(str(root['a']))
+    eq_(result.inodes[1], st.st_ino)
+    eq_(result.modes[1], st.st_mode)
+    eq_(result.mtimes[1], st.st_mtime)
+
+def test_stat_many_serial_uses_scandir_cache(tmpdir):
+    root = make_tree(tmpdir)
+    paths = sorted(root.listdir(with_stat=True))
+    tmpdir.join('file1').remove()
+    result = stat_many(paths, workers=1)
+    # The stat info of file1 was cached by listdir()
+    eq_(list(result.failed), [0, 0, 0])
+
+def test_pathset(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    ps = PathSet(['/foo/bar', '/foo/bar/baz/qux', '/other'])
+    eq_(len(ps), 3)
+    assert '/foo/bar' in ps
+    assert Path('/foo') not in ps
+    ps.add('/foo/bar')
+    eq_(len(ps), 3)
+    eq_(sorted(ps), [Path('/foo/bar'), Path('/foo/bar/baz/qux'), Path('/other')])
+
+def test_pathset_has_ancestor_of(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    ps = PathSet(['/foo/bar', '/other'])
+    assert ps.has_ancestor_of('/foo/bar')
+    assert ps.has_ancestor_of('/foo/bar/baz')
+    assert ps.has_ancestor_of(Path('/other/x/y'))
+    assert not ps.has_ancestor_of('/foo')
+    assert not ps.has_ancestor_of('/foo/baz')
+    assert not PathSet().has_ancestor_of('/foo')
+
+def test_pathset_longest_prefix(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    ps = PathSet(['/foo', '/foo/bar/baz'])
+    eq_(ps.longest_prefix('/foo/bar/baz/qux'), Path('/foo/bar/baz'))
+    eq_(ps.longest_prefix('/foo/bar/qux'), Path('/foo'))
+    eq_(ps.longest_prefix('/foo'), Path('/foo'))
+    assert ps.longest_prefix('/bar') is None
+
+def test_pathset_descendants_of(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    ps = PathSet(['/foo', '/foo/bar/baz', '/foo/qux', '/other'])
+    eq_(sorted(ps.descendants_of('/foo')), [Path('/foo'), Path('/foo/bar/baz'), Path('/foo/qux')])
+    eq_(list(ps.descendants_of('/foo/bar')), [Path('/foo/bar/baz')])
+    eq_(list(ps.descendants_of('/nothing')), [])
+
+def test_pathset_remove(monkeypatch):
+    monkeypatch.setattr(os, 'sep', '/')
+    ps = PathSet(['/foo', '/foo/bar/baz'])
+    with raises(KeyError):
+        ps.remove('/foo/bar')
+    ps.remove('/foo/bar/baz')
+    eq_(len(ps), 1)
+    assert not ps.has_ancestor_of('/bar')
+    eq_(ps._root, {'': {'foo': {None: True}}}) # empty nodes are pruned
+    ps.remove('/foo')
+    eq_(ps._root, {})
+
+def test_pathify_keeps_paths_and_other_args_as_is():
+    @pathify
+    def foo(a, b: Path, *args, c: Path=None, **kwargs):
+        return a, b, args, c, kwargs
+    
+    p = Path('foo')
+    a, b, args, c, kwargs = foo('a', p, 'x', c='bar', d='baz')
+    eq_(a, 'a')
+    assert b is p
+    eq_(args, ('x', ))
+    assert isinstance(c, Path)
+    eq_(c, Path('bar'))
+    eq_(kwargs, {'d': 'baz'})
+    eq_(foo('a', b='b')[1], Path('b'))
+
+def test_pathify_without_annotations_returns_function():
+    def foo(a, b):
+        pass
+    
+    assert pathify(foo) is foo
+
+def test_pathify_wrapper_has_the_same_signature():
+    sentinel = object()
+    
+    @pathify
+    def foo(a: Path, b=sentinel, *, c: Path='default'):
+        return a, b, c
+    
+    a, b, c = foo('foo')
+    assert b is sentinel
+    eq_(c, Path('default'))
+    with raises(TypeError):
+        foo()
+    with raises(TypeError):
+        foo('foo', 'bar', 'baz')
+    eq_(foo.__name__, 'foo')
+
+def test_copy(tmpdir):
+    src = tmpdir.join('src')
+    src.write('foobar')
+    src.chmod(0o640)
+    tmpdir.mkdir('dir')
+    p = Path(str(src))
+    eq_(p.copy(str(tmpdir.join('dst'))), str(tmpdir.join('dst')))
+    eq_(tmpdir.join('dst').read(), 'foobar')
+    eq_(tmpdir.join('dst').stat().mode & 0o777, 0o640)
+    # Copying to a folder copies under the same name
+    eq_(p.copy(Path(str(tmpdir.join('dir')))), str(tmpdir.join('dir', 'src')))
+    eq_(tmpdir.join('dir', 'src').read(), 'foobar')
+    with raises(shutil.SameFileError):
+        p.copy(p)
+    eq_(src.read(), 'foobar')
+
+def test_copy_falls_back_to_read_write(tmpdir, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "unsupported")
+    monkeypatch.setattr(pathmod, 'fcntl', None)
+    monkeypatch.setattr(os, 'copy_file_range', unsupported, raising=False)
+    monkeypatch.setattr(os, 'sendfile', unsupported, raising=False)
+    monkeypatch.setattr(pathmod, 'COPY_CHUNK_SIZE', 4)
+    tmpdir.join('src').write('foobarbaz')
+    progress = []
+    copy_file(str(tmpdir.join('src')), str(tmpdir.join('dst')), progress.append)
+    eq_(tmpdir.join('dst').read(), 'foobarbaz')
+    eq_(progress, [4, 4, 1])
+
+def test_copy_falls_back_when_kernel_copies_nothing(tmpdir, monkeypatch):
+    monkeypatch.setattr(pathmod, 'fcntl', None)
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    tmpdir.join('src').write('foobarbaz')
+    progress = []
+    copy_file(str(tmpdir.join('src')), str(tmpdir.join('dst')), progress.append)
+    eq_(tmpdir.join('dst').read(), 'foobarbaz')
+    eq_(progress, [9])
+
+def test_copy_kernel_side_in_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr(pathmod, 'fcntl', None) # no reflink
+    monkeypatch.setattr(pathmod, 'COPY_CHUNK_SIZE', 4)
+    tmpdir.join('src').write('foobarbaz')
+    progress = []
+    copy_file(str(tmpdir.join('src')), str(tmpdir.join('dst')), progress.append)
+    eq_(tmpdir.join('dst').read(), 'foobarbaz')
+    eq_(sum(progress), 9)
+
+def test_copytree(tmpdir):
+    root = make_tree(tmpdir.mkdir('src'))
+    root['file1'].open('w').write('foo')
+    root['a']['b']['c']['file3'].open('w').write('barbaz')
+    os.utime(str(root['a']), (0, 0))
+    progress = []
+    def callback(p, desc=''):
+        progress.append(p)
+        return True
+    dest = Path(str(tmpdir.join('dst')))
+    root.copytree(dest, workers=2, j=Job(1, callback))
+    eq_(sorted(p[dest:] for p in dest.walk()), sorted(p[root:] for p in root.walk()))
+    eq_(dest['a']['b']['c']['file3'].open().read(), 'barbaz')
+    eq_(progress[-1], 100)
+    # Folder stats are copied after the files are created
+    eq_(dest['a'].stat().st_mtime, 0)
+
+def test_copytree_gathers_errors(tmpdir, monkeypatch):
+    root = make_tree(tmpdir.mkdir('src'))
+    old_copy_data = pathmod._copy_data
+    def copy_data(src, dst, progress):
+        if src.endswith('file2'):
+            raise PermissionError("denied")
+        old_copy_data(src, dst, progress)
+    monkeypatch.setattr(pathmod, '_copy_data', copy_data)
+    dest = Path(str(tmpdir.join('dst')))
+    with raises(shutil.Error) as excinfo:
+        root.copytree(dest)
+    [(src, dst, reason)] = excinfo.value.args[0]
+    eq_(src, str(root['a']['file2']))
+    assert dest['a']['b']['c']['file3'].exists()
+
+def test_copy_many(tmpdir):
+    pairs = []
+    for i in range(10):
+        tmpdir.join('src%d' % i).write('x' * i)
+        pairs.append((Path(str(tmpdir.join('src%d' % i))), str(tmpdir.join('dst%d' % i))))
+    result = copy_many(pairs, workers=3)
+    eq_(result, [dst for src, dst in pairs])
+    for i in range(10):
+        eq_(tmpdir.join('dst%d' % i).read(), 'x' * i)
+
+def test_copytree_completes_copies_when_copytree_fails(tmpdir, monkeypatch):
+    # When shutil.copytree() gathers errors of its own, our queued copies still go through and
+    # the errors are merged.
+    src = tmpdir.mkdir('src')
+    for i in range(50):
+        src.join('file%d' % i).write('foo')
+    src.mkdir('sub').join('file').write('bar')
+    old_copystat = shutil.copystat
+    def copystat(s, d, **kwargs):
+        if s == str(src.join('sub')):
+            raise PermissionError("denied")
+        old_copystat(s, d, **kwargs)
+    monkeypatch.setattr(shutil, 'copystat', copystat)
+    dest = Path(str(tmpdir.join('dst')))
+    with raises(shutil.Error) as excinfo:
+        Path(str(src)).copytree(dest, workers=2)
+    eq_(len(dest.listdir()), 51)
+    eq_(dest['sub']['file'].open().read(), 'bar')
+    errors = excinfo.value.args[0]
+    # Once by shutil.copytree(), once when we copy folder stats again.
+    eq_([e[0] for e in errors], [str(src.join('sub'))] * 2)
+
+def test_copytree_doesnt_support_copy_function(tmpdir):
+    root = make_tree(tmpdir.mkdir('src'))
+    with raises(TypeError):
+        root.copytree(str(tmpdir.join('dst')), copy_function=shutil.copy)
+
+def test_copy_special_files(tmpdir):
+    fifo = str(tmpdir.join('fifo'))
+    os.mkfifo(fifo)
+    tmpdir.join('file').write('foo')
+    with raises(shutil.SpecialFileError):
+        Path(fifo).copy(str(tmpdir.join('dst')))
+    with raises(shutil.SpecialFileError):
+        Path(str(tmpdir.join('file'))).copy(fifo)
+    with raises(shutil.SpecialFileError):
+        Path(str(tmpdir)).copy(str(tmpdir.join('dst')))
+
+def test_walk_symlink_loops(tmpdir):
+    root = make_tree(tmpdir)
+    # Two links to ancestors: without loop detection, the walk would never end.
+    os.symlink(str(root), str(root['a']['b']['up']))
+    os.symlink(str(root['a']), str(root['x']['y']['up']))
+    result = walked(root, follow_symlinks=True)
+    # Links to ancestors are yielded, but not walked into.
+    assert ('a', 'b', 'up') in result
+    assert ('a', 'b', 'up', 'file1') not in result
+    # x/y/up isn't an ancestor of x/y, so we walk into it, but not into x/y/up/b/up.
+    eq_([p for p in result if p[-1] == 'file3'], [
+        ('a', 'b', 'c', 'file3'), ('x', 'y', 'up', 'b', 'c', 'file3'),
+    ])
+    assert ('x', 'y', 'up', 'b', 'up') in result
+    assert ('x', 'y', 'up', 'b', 'up', 'file1') not in result
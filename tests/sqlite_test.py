@@ -9,12 +9,18 @@
 import time
 import threading
 import os
+import asyncio
 import sqlite3 as sqlite
 
-from pytest import raises
+from pytest import raises, importorskip
 
 from ..testutil import eq_
-from ..sqlite import ThreadedConn
+from ..jobprogress.job import Job, JobCancelled
+from ..sqlite import (
+    ThreadedConn, PooledConn, AsyncThreadedConn, ShardedConn, default_route,
+    profile_queries, QueryMetrics, ResultCache, is_readonly,
+    normalize_sql, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+)
 
 # Threading is hard to test. In a lot of those tests, a failure means that the test run will
 # hang forever. Well... I don't know a better alternative.
@@ -124,3 +130,866 @@ def test_non_ascii_dbdir(tmpdir):
     dbdir = tmpdir.join('foo\u00e9')
     os.mkdir(str(dbdir))
     ThreadedConn(str(dbdir.join('foo.db')), True)
+
+def test_executemany():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    result = con.executemany('insert into foo(bar) values(?)', ([i] for i in range(100)))
+    eq_(100, result.rowcount)
+    result = con.execute('select count(*), sum(bar) from foo')
+    eq_((100, 4950), result[0])
+
+def test_executemany_exception():
+    con = ThreadedConn(':memory:', True)
+    with raises(sqlite.OperationalError):
+        con.executemany('insert into bleh(bar) values(?)', [[1], [2]])
+
+def test_execute_batch():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar TEXT)')
+    results = con.execute_batch([
+        ('insert into foo(bar) values(?)', ['baz1']),
+        ('insert into foo(bar) values(?)', ['baz2']),
+        ('select bar from foo', ),
+    ])
+    eq_(3, len(results))
+    eq_(1, results[0].lastrowid)
+    eq_(2, results[1].lastrowid)
+    eq_([('baz1', ), ('baz2', )], results[2])
+    eq_(2, con.lastrowid)
+
+def test_execute_batch_stops_at_exception():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar TEXT)')
+    with raises(sqlite.OperationalError):
+        con.execute_batch([
+            ('insert into foo(bar) values(\'baz\')', ()),
+            ('select * from bleh', ()),
+            ('insert into foo(bar) values(\'baz\')', ()),
+        ])
+    eq_(1, len(con.execute('select * from foo')))
+
+def test_submit():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    futures = [con.submit('insert into foo(bar) values(?)', [i]) for i in range(10)]
+    eq_(list(range(1, 11)), [f.result().lastrowid for f in futures])
+    eq_((10, ), con.execute('select count(*) from foo')[0])
+
+def test_submit_exception():
+    con = ThreadedConn(':memory:', True)
+    future = con.submit('select * from bleh')
+    with raises(sqlite.OperationalError):
+        future.result()
+
+def test_submit_from_multiple_threads():
+    def run(start):
+        futures = [con.submit('insert into foo(bar) values(?)', [i]) for i in range(start, start+50)]
+        for f in futures:
+            f.result()
+    
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    threads = [threading.Thread(target=run, args=(i*50, )) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    eq_((200, 19900), con.execute('select count(*), sum(bar) from foo')[0])
+
+def test_submit_after_close():
+    con = ThreadedConn(':memory:', True)
+    con.close()
+    assert con.submit('select 1').result() is None
+
+def test_fetchmany_on_results():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(5)])
+    result = con.execute('select bar from foo')
+    eq_([(0, ), (1, )], result.fetchmany(2))
+    eq_((2, ), result.fetchone())
+    eq_([(3, ), (4, )], result.fetchall())
+    eq_([(3, ), (4, )], result.fetchmany(3))
+    eq_([], result.fetchmany(2))
+    assert result.fetchone() is None
+
+def test_fetched_rows_are_hidden_from_results():
+    # Like when rows were popped: once fetched, rows aren't part of the list anymore.
+    def fetched_one():
+        result = con.execute('select bar from foo')
+        eq_((0, ), result.fetchone())
+        return result
+    
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(4)])
+    result = fetched_one()
+    eq_([(1, ), (2, ), (3, )], list(result))
+    eq_(3, len(result))
+    eq_((1, ), result[0])
+    eq_((3, ), result[-1])
+    eq_([(2, ), (3, )], result[1:])
+    with raises(IndexError):
+        result[3]
+    assert (0, ) not in fetched_one()
+    eq_(fetched_one(), [(1, ), (2, ), (3, )])
+    eq_('[(1,), (2,), (3,)]', repr(fetched_one()))
+    eq_([(3, ), (2, ), (1, )], list(reversed(fetched_one())))
+    eq_(0, fetched_one().index((1, )))
+    eq_(0, fetched_one().count((0, )))
+    eq_((1, ), fetched_one().pop(0))
+    eq_([(1, ), (2, ), (3, )], fetched_one() + [])
+    eq_([(1, ), (2, ), (3, )], fetched_one().copy())
+    result = fetched_one()
+    result[0] = 'x'
+    eq_(['x', (2, ), (3, )], result)
+    result = fetched_one()
+    result.fetchmany(5)
+    assert not result
+
+def test_fetched_rows_are_dropped_when_they_are_the_majority():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(4)])
+    result = con.execute('select bar from foo')
+    result.fetchone()
+    eq_(4, list.__len__(result))
+    result.fetchmany(2)
+    eq_(1, list.__len__(result))
+    eq_((3, ), result.fetchone())
+    assert result.fetchone() is None
+
+def test_stream():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(25)])
+    cur = con.stream('select bar from foo order by bar', chunksize=10)
+    eq_((0, ), cur.fetchone())
+    eq_([(i, ) for i in range(1, 16)], cur.fetchmany(15))
+    eq_([(i, ) for i in range(16, 25)], list(cur))
+    assert cur.fetchone() is None
+    eq_([], cur.fetchall())
+
+def test_stream_interleaved_with_other_queries():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(10)])
+    cur = con.stream('select bar from foo', chunksize=3)
+    eq_((0, ), cur.fetchone())
+    eq_((10, ), con.execute('select count(*) from foo')[0])
+    eq_(9, len(cur.fetchall()))
+
+def test_stream_close_releases_cursor():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(10)])
+    cur = con.stream('select bar from foo', chunksize=3)
+    cur.close()
+    assert cur.fetchone() is None
+    con.execute('select 1') # make sure the close message has been processed
+    eq_({}, con._t._cursors)
+
+def test_stream_exception():
+    con = ThreadedConn(':memory:', True)
+    with raises(sqlite.OperationalError):
+        con.stream('select * from bleh')
+
+def test_is_readonly():
+    assert is_readonly('select * from foo')
+    assert is_readonly('  SELECT 1')
+    assert is_readonly('with bar as (select 1) select * from bar')
+    assert not is_readonly('with bar as (select 1) insert into foo select * from bar')
+    assert not is_readonly('insert into foo(bar) values(1)')
+    assert not is_readonly('pragma journal_mode = wal')
+
+def test_pooled_conn_routes_reads_to_readers(tmpdir):
+    dbpath = str(tmpdir.join('foo.db'))
+    con = PooledConn(dbpath, True, readers=2)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(10)])
+    reader = con._thread_for('select * from foo')
+    assert reader in con._readers
+    eq_((10, ), reader.execute('select count(*) from foo')[0])
+    eq_((10, ), con.execute('select count(*) from foo')[0])
+    assert con._thread_for('insert into foo(bar) values(1)') is con._t
+    eq_(('wal', ), con.execute('pragma journal_mode')[0])
+
+def test_pooled_conn_readers_are_read_only(tmpdir):
+    con = PooledConn(str(tmpdir.join('foo.db')), True, readers=1)
+    con.execute('create table foo(bar INTEGER)')
+    with raises(sqlite.OperationalError):
+        con._readers[0].execute('insert into foo(bar) values(1)')
+
+def test_pooled_conn_reads_own_uncommitted_writes(tmpdir):
+    con = PooledConn(str(tmpdir.join('foo.db')), False, readers=1)
+    con.execute('create table foo(bar INTEGER)')
+    con.commit()
+    con.execute('insert into foo(bar) values(1)')
+    assert con._thread_for('select * from foo') is con._t
+    eq_(1, len(con.execute('select * from foo')))
+    con.commit()
+    assert con._thread_for('select * from foo') is con._readers[0]
+    eq_(1, len(con.execute('select * from foo')))
+
+def test_pooled_conn_stream_from_reader(tmpdir):
+    con = PooledConn(str(tmpdir.join('foo.db')), True, readers=1)
+    con.execute('create table foo(bar INTEGER)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(10)])
+    eq_(10, len(con.stream('select * from foo', chunksize=3).fetchall()))
+
+def test_pooled_conn_memory_db():
+    with raises(ValueError):
+        PooledConn(':memory:', True)
+
+def test_async_execute():
+    async def insert(i):
+        result = await con.execute('insert into foo(bar) values(?)', [i])
+        return result.lastrowid
+    
+    async def run():
+        await con.execute('create table foo(bar INTEGER)')
+        rowids = await asyncio.gather(*[insert(i) for i in range(100)])
+        eq_(set(range(1, 101)), set(rowids))
+        result = await con.execute('select count(*), sum(bar) from foo')
+        eq_((100, 4950), result[0])
+        await con.close()
+    
+    con = AsyncThreadedConn(':memory:', True)
+    asyncio.run(run())
+
+def test_async_commit_and_rollback():
+    async def run():
+        await con.execute('create table foo(bar TEXT)')
+        await con.commit()
+        await con.executemany('insert into foo(bar) values(?)', [['baz1'], ['baz2']])
+        await con.rollback()
+        eq_(0, len(await con.execute('select * from foo')))
+        await con.execute_batch([('insert into foo(bar) values(?)', ['baz'])])
+        await con.commit()
+        eq_(1, len(await con.execute('select * from foo')))
+    
+    con = AsyncThreadedConn(':memory:', False)
+    asyncio.run(run())
+
+def test_async_result_cache():
+    async def run():
+        await con.execute('create table foo(bar INTEGER)')
+        await con.commit()
+        eq_(0, len(await con.execute('select * from foo')))
+        eq_(0, len(await con.execute('select * from foo')))
+        eq_(1, con.cache.hits)
+        await con.executemany('insert into foo(bar) values(?)', [[1], [2]], PRIORITY_HIGH)
+        eq_(2, len(await con.execute('select * from foo')))
+        await con.rollback()
+        eq_(0, len(await con.execute('select * from foo')))
+        await con.execute_batch([('insert into foo(bar) values(?)', [1])], PRIORITY_LOW)
+        eq_(1, len(await con.execute('select * from foo')))
+        await con.commit()
+        eq_(1, len(await con.execute('select * from foo')))
+        await con.close()
+    
+    con = AsyncThreadedConn(':memory:', False, cache_size=10)
+    asyncio.run(run())
+
+def test_async_exception():
+    async def run():
+        with raises(sqlite.OperationalError):
+            await con.execute('select * from bleh')
+    
+    con = AsyncThreadedConn(':memory:', True)
+    asyncio.run(run())
+
+def test_group_commit(tmpdir):
+    dbpath = str(tmpdir.join('foo.db'))
+    con = ThreadedConn(dbpath, True, group_commit_window=0.5, group_commit_size=10)
+    con.execute('create table foo(bar INTEGER)')
+    futures = [con.submit('insert into foo(bar) values(?)', [i]) for i in range(25)]
+    eq_(list(range(1, 26)), [f.result().lastrowid for f in futures])
+    assert not con._t.in_transaction
+    # It's all committed
+    other = ThreadedConn(dbpath, True)
+    eq_((25, ), other.execute('select count(*) from foo')[0])
+
+def test_group_commit_results_wait_for_commit(tmpdir):
+    dbpath = str(tmpdir.join('foo.db'))
+    con = ThreadedConn(dbpath, True, group_commit_window=0.2, group_commit_size=100)
+    con.execute('create table foo(bar INTEGER)')
+    start = time.monotonic()
+    future = con.submit('insert into foo(bar) values(1)')
+    future.result()
+    assert time.monotonic() - start >= 0.2
+    other = ThreadedConn(dbpath, True)
+    eq_((1, ), other.execute('select count(*) from foo')[0])
+
+def test_group_commit_failed_statement_doesnt_fail_group():
+    con = ThreadedConn(':memory:', True, group_commit_window=0.5, group_commit_size=3)
+    con.execute('create table foo(bar INTEGER UNIQUE)')
+    futures = [con.submit('insert into foo(bar) values(?)', [i]) for i in [1, 1, 2]]
+    futures[0].result()
+    with raises(sqlite.IntegrityError):
+        futures[1].result()
+    futures[2].result()
+    eq_((2, ), con.execute('select count(*) from foo')[0])
+
+def test_group_commit_stops_at_non_dml():
+    con = ThreadedConn(':memory:', True, group_commit_window=10, group_commit_size=100)
+    con.execute('create table foo(bar INTEGER)')
+    start = time.monotonic()
+    con.submit('insert into foo(bar) values(1)')
+    # The select breaks the group without waiting for the window's end
+    eq_((1, ), con.execute('select count(*) from foo')[0])
+    assert time.monotonic() - start < 5
+
+def test_normalize_sql():
+    eq_("select * from foo where bar = ? and baz in (?)",
+        normalize_sql("select *  from foo\nwhere bar = 'it''s' and baz in (1, 2.5, ?)"))
+    eq_("select t1.bar from t1", normalize_sql("select t1.bar from t1"))
+
+def test_metrics():
+    metrics = QueryMetrics()
+    con = ThreadedConn(':memory:', True, metrics=metrics)
+    con.execute('create table foo(bar INTEGER)')
+    for i in range(3):
+        con.execute('insert into foo(bar) values(%d)' % i)
+    con.execute('select * from foo')
+    with raises(sqlite.OperationalError):
+        con.execute('select * from bleh')
+    stats = metrics.statements['insert into foo(bar) values(?)']
+    eq_(3, stats.count)
+    eq_(3, sum(stats.histogram))
+    assert stats.percentile(0.5) is not None
+    eq_(3, metrics.statements['select * from foo'].rows)
+    eq_(1, metrics.statements['select * from bleh'].errors)
+    assert metrics.max_queue_depth >= 1
+
+def test_metrics_slow_query_hook():
+    def on_slow_query(sql, elapsed, plan):
+        slow.append((sql, plan))
+    
+    slow = []
+    metrics = QueryMetrics(slow_query_threshold=0, on_slow_query=on_slow_query)
+    con = ThreadedConn(':memory:', True, metrics=metrics)
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('select * from foo where bar = ?', [1])
+    sql, plan = slow[-1]
+    eq_('select * from foo where bar = ?', sql)
+    assert any('SCAN' in row[-1] for row in plan)
+
+def test_cache_hit_skips_db_thread():
+    con = ThreadedConn(':memory:', True, cache_size=10)
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('insert into foo(bar) values(1)')
+    eq_([(1, )], con.execute('select bar from foo where bar = ?', [1]))
+    con._t.close() # the DB thread won't answer anymore
+    result = con.execute('select bar from foo where bar = ?', [1])
+    eq_([(1, )], result)
+    eq_((1, ), result.fetchone())
+    eq_(1, con.cache.hits)
+    # The cached result isn't affected by what's done with the returned one
+    eq_([(1, )], con.execute('select bar from foo where bar = ?', [1]).fetchall())
+
+def test_cache_hit_doesnt_change_lastrowid():
+    con = ThreadedConn(':memory:', True, cache_size=10)
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('create table baz(bar INTEGER)')
+    con.execute('insert into foo(bar) values(1)')
+    con.execute('select bar from foo')
+    con.execute('insert into baz(bar) values(1)')
+    con.execute('insert into baz(bar) values(2)')
+    eq_(2, con.lastrowid)
+    result = con.execute('select bar from foo')
+    eq_(1, con.cache.hits)
+    eq_(2, con.lastrowid)
+    eq_(2, result.lastrowid)
+
+def test_cache_invalidated_by_writes_to_the_table():
+    con = ThreadedConn(':memory:', True, cache_size=10)
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('create table baz(bar INTEGER)')
+    eq_(0, len(con.execute('select * from foo')))
+    eq_(0, len(con.execute('select * from baz')))
+    con.execute('insert into foo(bar) values(1)')
+    eq_(1, len(con.cache))
+    eq_(1, len(con.execute('select * from foo')))
+    con.executemany('insert into "baz"(bar) values(?)', [[1], [2]])
+    eq_(2, len(con.execute('select * from baz')))
+    con.submit('delete from main.baz').result()
+    eq_(0, len(con.execute('select * from baz')))
+
+def test_cache_invalidated_by_rollback():
+    con = ThreadedConn(':memory:', False, cache_size=10)
+    con.execute('create table foo(bar INTEGER)')
+    con.commit()
+    con.execute('insert into foo(bar) values(1)')
+    eq_(1, len(con.execute('select * from foo')))
+    con.rollback()
+    eq_(0, len(con.execute('select * from foo')))
+
+def test_cache_cleared_by_ddl():
+    con = ThreadedConn(':memory:', True, cache_size=10)
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('select * from foo')
+    eq_(1, len(con.cache))
+    con.execute('drop table foo')
+    eq_(0, len(con.cache))
+
+def test_cache_invalidation_sees_joins_views_and_triggers():
+    con = ThreadedConn(':memory:', True, cache_size=10)
+    con.execute('create table a(x INTEGER)')
+    con.execute('create table b(y INTEGER)')
+    con.execute('create table log(z INTEGER)')
+    con.execute('create view v as select x from a')
+    con.execute('create trigger t after insert on b begin insert into log values(new.y); end')
+    eq_(0, len(con.execute('select x, y from a, b')))
+    eq_(0, len(con.execute('select * from v')))
+    eq_(0, con.execute('select count(*) from log')[0][0])
+    con.execute('insert into b(y) values(1)')
+    eq_(1, con.execute('select count(*) from log')[0][0]) # written by the trigger
+    con.execute('insert into a(x) values(1)')
+    eq_(1, len(con.execute('select x, y from a, b')))
+    eq_([(1, )], con.execute('select * from v'))
+    # Prepared statements are reused, the tables must still be known the second time.
+    con.execute('insert into b(y) values(2)')
+    eq_(2, con.execute('select count(*) from log')[0][0])
+    eq_(2, len(con.execute('select x, y from a, b')))
+
+def test_cache_lru_eviction():
+    cache = ResultCache(max_entries=2)
+    for i in range(3):
+        cache.put(('select * from foo', (i, )), {'foo'}, [(i, )], cache.generation)
+    eq_(2, len(cache))
+    assert cache.get(('select * from foo', (0, ))) is None
+    cache.get(('select * from foo', (1, )))
+    cache.put(('select * from foo', (3, )), {'foo'}, [(3, )], cache.generation)
+    assert cache.get(('select * from foo', (1, ))) is not None
+    assert cache.get(('select * from foo', (2, ))) is None
+
+def test_cache_memory_eviction():
+    cache = ResultCache(max_entries=100, max_memory=20000)
+    rows = [(i, 'x' * 50) for i in range(50)]
+    for i in range(10):
+        cache.put(('select * from foo', (i, )), {'foo'}, rows, cache.generation)
+    assert cache.memory <= 20000
+    assert 0 < len(cache) < 10
+
+def test_cache_doesnt_store_results_older_than_an_invalidation():
+    cache = ResultCache()
+    generation = cache.generation
+    cache.invalidate_writes({'foo'})
+    cache.put(('select * from foo', ()), {'foo'}, [], generation)
+    eq_(0, len(cache))
+
+def keep_db_thread_busy(con, duration):
+    # Returns once the DB thread is busy sleeping so that queries queued afterwards wait in the queue
+    started = threading.Event()
+    def sleep(db):
+        started.set()
+        time.sleep(duration)
+    
+    con._t.submit_query(sleep)
+    started.wait()
+
+def test_priorities():
+    con = ThreadedConn(':memory:', True, max_queue_wait=None)
+    con.execute('create table foo(bar TEXT)')
+    keep_db_thread_busy(con, 0.2)
+    futures = [
+        con.submit('insert into foo(bar) values(?)', ['low'], PRIORITY_LOW),
+        con.submit('insert into foo(bar) values(?)', ['normal'], PRIORITY_NORMAL),
+        con.submit('insert into foo(bar) values(?)', ['high'], PRIORITY_HIGH),
+    ]
+    for f in futures:
+        f.result()
+    eq_([('high', ), ('normal', ), ('low', )], con.execute('select bar from foo order by rowid'))
+    stats = con.queue_stats()
+    eq_(1, stats[PRIORITY_HIGH].served)
+    eq_(1, stats[PRIORITY_LOW].max_depth)
+    eq_(0, stats[PRIORITY_LOW].depth)
+
+def test_priorities_starvation_protection():
+    con = ThreadedConn(':memory:', True, max_queue_wait=0.1)
+    con.execute('create table foo(bar TEXT)')
+    keep_db_thread_busy(con, 0.2)
+    low = con.submit('insert into foo(bar) values(?)', ['low'], PRIORITY_LOW)
+    high = con.submit('insert into foo(bar) values(?)', ['high'], PRIORITY_HIGH)
+    low.result()
+    high.result()
+    eq_([('low', ), ('high', )], con.execute('select bar from foo order by rowid'))
+    eq_(1, con.queue_stats()[PRIORITY_LOW].promoted)
+
+def test_close_waits_for_low_priority_queries():
+    con = ThreadedConn(':memory:', True, max_queue_wait=None)
+    con.execute('create table foo(bar TEXT)')
+    future = con.submit('insert into foo(bar) values(\'baz\')', priority=PRIORITY_LOW)
+    con.close()
+    eq_(1, future.result().lastrowid)
+
+def test_async_close_waits_for_low_priority_queries():
+    async def run():
+        await con.execute('create table foo(bar TEXT)')
+        keep_db_thread_busy(con._conn, 0.1)
+        low = con._conn.submit('insert into foo(bar) values(\'baz\')', priority=PRIORITY_LOW)
+        await con.close()
+        eq_(1, low.result().lastrowid)
+    
+    con = AsyncThreadedConn(':memory:', True, max_queue_wait=None)
+    asyncio.run(run())
+
+def test_run_on_db_thread():
+    con = ThreadedConn(':memory:', True)
+    eq_(True, con.run_on_db_thread(lambda db: isinstance(db, sqlite.Connection)))
+    with raises(ZeroDivisionError):
+        con.run_on_db_thread(lambda db: 1 / 0)
+
+def test_transaction_with_statements(tmpdir):
+    dbpath = str(tmpdir.join('foo.db'))
+    con = ThreadedConn(dbpath, True)
+    con.execute('create table foo(bar TEXT)')
+    results = con.transaction([
+        ('insert into foo(bar) values(?)', ['baz1']),
+        ('insert into foo(bar) values(?)', ['baz2']),
+        ('select count(*) from foo', ),
+    ])
+    eq_([(2, )], results[2])
+    other = ThreadedConn(dbpath, True)
+    eq_((2, ), other.execute('select count(*) from foo')[0])
+
+def test_transaction_with_callable():
+    def transfer(db):
+        db.execute('update account set balance = balance - 10 where id = 1')
+        db.execute('update account set balance = balance + 10 where id = 2')
+        return db.execute('select sum(balance) from account').fetchone()[0]
+    
+    con = ThreadedConn(':memory:', False)
+    con.execute('create table account(id INTEGER PRIMARY KEY, balance INTEGER)')
+    con.executemany('insert into account(balance) values(?)', [[100], [100]])
+    con.commit()
+    eq_(200, con.transaction(transfer))
+    con.rollback() # already committed
+    eq_([(90, ), (110, )], con.execute('select balance from account order by id'))
+
+def test_transaction_rolled_back_on_exception():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar TEXT)')
+    with raises(sqlite.OperationalError):
+        con.transaction([
+            ('insert into foo(bar) values(?)', ['baz']),
+            ('insert into bleh(bar) values(?)', ['baz']),
+        ])
+    eq_(0, len(con.execute('select * from foo')))
+    con.transaction([('insert into foo(bar) values(?)', ['baz'])])
+    eq_(1, len(con.execute('select * from foo')))
+
+def test_transaction_nested_in_pending_transaction():
+    con = ThreadedConn(':memory:', False)
+    con.execute('create table foo(bar TEXT)')
+    con.commit()
+    con.execute('insert into foo(bar) values(\'pending\')')
+    with raises(sqlite.OperationalError):
+        con.transaction([('insert into foo(bar) values(\'unit\')', ()), ('select * from bleh', ())])
+    # The pending insert is still there, but not the one from the failed unit
+    eq_([('pending', )], con.execute('select bar from foo'))
+    con.transaction([('insert into foo(bar) values(\'unit\')', ())])
+    con.rollback()
+    eq_(0, len(con.execute('select * from foo')))
+
+def test_execute_columnar():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(i INTEGER, r REAL, mixed, s TEXT)')
+    con.executemany('insert into foo values(?, ?, ?, ?)', [
+        [i, i / 2, i if i % 2 else i + 0.5, 'baz%d' % i] for i in range(25)
+    ])
+    result = con.execute_columnar('select * from foo', use_numpy=False, chunksize=10)
+    eq_(['i', 'r', 'mixed', 's'], list(result))
+    eq_('q', result['i'].typecode)
+    eq_(list(range(25)), result['i'].tolist())
+    eq_('d', result['r'].typecode)
+    eq_(6.0, result['r'][12])
+    eq_('d', result['mixed'].typecode) # downgraded on the first float
+    eq_([0.5, 1.0], result['mixed'][:2].tolist())
+    eq_('baz3', result['s'][3])
+    assert isinstance(result['s'], list)
+
+def test_execute_columnar_nulls_and_big_values():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(a INTEGER, b INTEGER)')
+    con.executemany('insert into foo values(?, ?)', [[1, 2**62], [None, 3]])
+    result = con.execute_columnar('select * from foo', use_numpy=False, chunksize=1)
+    eq_([1, None], result['a'])
+    eq_([2**62, 3], result['b'].tolist())
+
+def test_execute_columnar_type_change_mid_chunk():
+    # When a value forcing a type change isn't the first of its chunk, the values before it are
+    # only added once.
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(a)')
+    con.executemany('insert into foo values(?)', [[1], [2], [2.5], [None], [4]])
+    result = con.execute_columnar('select a from foo', use_numpy=False, chunksize=10)
+    eq_([1, 2, 2.5, None, 4], result['a'])
+    result = con.execute_columnar('select a from foo where a is not null', use_numpy=False)
+    eq_('d', result['a'].typecode)
+    eq_([1, 2, 2.5, 4], result['a'].tolist())
+
+def test_execute_columnar_numpy():
+    numpy = importorskip('numpy')
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(i INTEGER, r REAL)')
+    con.executemany('insert into foo values(?, ?)', [[i, i / 2] for i in range(10)])
+    result = con.execute_columnar('select i, r from foo')
+    eq_(numpy.int64, result['i'].dtype)
+    eq_(45, result['i'].sum())
+    eq_(numpy.float64, result['r'].dtype)
+
+def test_run_on_db_thread_base_exception():
+    # A callable raising an exception that doesn't derive from Exception doesn't kill the DB thread
+    con = ThreadedConn(':memory:', True)
+    def func(db):
+        raise SystemExit()
+    
+    with raises(SystemExit):
+        con.run_on_db_thread(func)
+    eq_([(1, )], con.execute('select 1'))
+
+def test_blob_read():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(data BLOB)')
+    data = bytes(range(256)) * 10
+    con.execute('insert into foo(data) values(?)', [data])
+    with con.blobopen('foo', 'data', con.lastrowid, chunksize=100) as blob:
+        eq_(2560, len(blob))
+        eq_(data[:10], blob.read(10))
+        eq_(10, blob.tell())
+        buffer = bytearray(1000)
+        eq_(1000, blob.readinto(buffer))
+        eq_(data[10:1010], buffer)
+        eq_(data[1010:], blob.read())
+        eq_(b'', blob.read())
+        blob.seek(-5, os.SEEK_END)
+        eq_(data[-5:], blob.read(100))
+
+def test_blob_readinto_memoryview():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(data BLOB)')
+    con.execute('insert into foo(data) values(?)', [b'abcdef'])
+    buffer = bytearray(10)
+    with con.blobopen('foo', 'data', 1, chunksize=4) as blob:
+        eq_(6, blob.readinto(memoryview(buffer)[2:]))
+    eq_(b'\0\0abcdef\0\0', buffer)
+
+def test_blob_write():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(data BLOB)')
+    con.execute('insert into foo(data) values(zeroblob(1000))')
+    data = bytes(range(200)) * 5
+    with con.blobopen('foo', 'data', 1, readonly=False, chunksize=64) as blob:
+        eq_(1000, blob.write(memoryview(data)))
+        with raises(ValueError):
+            blob.write(b'x')
+    eq_(data, con.execute('select data from foo')[0][0])
+
+def test_blob_write_invalidates_cache():
+    con = ThreadedConn(':memory:', True, cache_size=10)
+    con.execute('create table foo(data BLOB)')
+    con.execute('insert into foo(data) values(?)', [b'aaaa'])
+    with con.blobopen('foo', 'data', 1, readonly=False) as blob:
+        # Cached between the opening and the write
+        eq_(b'aaaa', con.execute('select data from foo')[0][0])
+        blob.write(b'bbbb')
+        eq_(b'bbbb', con.execute('select data from foo')[0][0])
+
+def test_blob_closed():
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(data BLOB)')
+    con.execute('insert into foo(data) values(?)', [b'abc'])
+    blob = con.blobopen('foo', 'data', 1)
+    blob.close()
+    with raises(ValueError):
+        blob.read()
+    con.execute('select 1')
+    eq_({}, con._t._blobs)
+
+def test_backup(tmpdir):
+    def progress(p, desc=''):
+        progresses.append(p)
+        return True
+    
+    progresses = []
+    con = ThreadedConn(str(tmpdir.join('foo.db')), True)
+    con.execute('create table foo(bar TEXT)')
+    con.executemany('insert into foo(bar) values(?)', [['x' * 1000] for i in range(100)])
+    destpath = str(tmpdir.join('backup.db'))
+    con.backup(destpath, pages_per_step=5, j=Job(1, progress)).result()
+    eq_(100, progresses[-1])
+    assert len(progresses) > 3
+    backup = ThreadedConn(destpath, True)
+    eq_((100, ), backup.execute('select count(*) from foo')[0])
+
+def test_backup_serves_queries_between_steps(tmpdir):
+    def progress(p, desc=''):
+        # Called on the DB thread
+        if not futures:
+            futures.append(con.submit('insert into foo(bar) values(?)', ['during backup']))
+            futures.append(con.submit('select count(*) from foo'))
+            futures[1].add_done_callback(lambda f: order.append('select'))
+            submitted.set()
+        return True
+    
+    futures = []
+    order = []
+    submitted = threading.Event()
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar TEXT)')
+    con.executemany('insert into foo(bar) values(?)', [['x' * 1000] for i in range(100)])
+    destpath = str(tmpdir.join('backup.db'))
+    backup_future = con.backup(destpath, pages_per_step=5, j=Job(1, progress))
+    submitted.wait()
+    eq_((101, ), futures[1].result()[0])
+    backup_future.add_done_callback(lambda f: order.append('backup'))
+    backup_future.result()
+    # The queries were served before the backup was done
+    eq_(['select', 'backup'], order)
+    backup = ThreadedConn(destpath, True)
+    # and the changes made during the backup are in it
+    eq_((101, ), backup.execute('select count(*) from foo')[0])
+
+def test_backup_cancelled(tmpdir):
+    con = ThreadedConn(':memory:', True)
+    con.execute('create table foo(bar TEXT)')
+    con.executemany('insert into foo(bar) values(?)', [['x' * 1000] for i in range(100)])
+    future = con.backup(str(tmpdir.join('backup.db')), pages_per_step=5, j=Job(1, lambda p, desc='': False))
+    with raises(JobCancelled):
+        future.result()
+    eq_((100, ), con.execute('select count(*) from foo')[0])
+
+def test_default_route():
+    eq_(2, default_route(5, 3))
+    eq_(default_route('foo', 4), default_route('foo', 4))
+    assert len({default_route('foo%d' % i, 4) for i in range(100)}) == 4
+
+def test_sharded_conn(tmpdir):
+    dbnames = [str(tmpdir.join('shard%d.db' % i)) for i in range(3)]
+    con = ShardedConn(dbnames, False)
+    con.execute_all('create table foo(id INTEGER PRIMARY KEY, bar TEXT)')
+    eq_(30, con.executemany(lambda v: v[0], 'insert into foo(id, bar) values(?, ?)',
+        [(i, 'baz%d' % i) for i in range(30)]))
+    con.execute(4, 'insert into foo(id, bar) values(?, ?)', [100, 'extra'])
+    eq_(10, len(con.shards[0].execute('select * from foo')))
+    eq_([(i, ) for i in range(1, 30, 3)],
+        con.shard_for(1).execute('select id from foo order by id')[:10])
+    con.commit()
+    del con
+    con = ShardedConn(dbnames, False)
+    result = con.execute_all('select id from foo order by id', order_key=lambda row: row[0])
+    eq_(list(range(30)) + [100], [row[0] for row in result])
+    eq_([(10, ), (11, ), (10, )], con.execute_all('select count(*) from foo'))
+
+def test_sharded_conn_rollback(tmpdir):
+    dbnames = [str(tmpdir.join('shard%d.db' % i)) for i in range(2)]
+    con = ShardedConn(dbnames, False)
+    con.execute_all('create table foo(id INTEGER PRIMARY KEY)')
+    con.commit()
+    con.executemany(lambda v: v[0], 'insert into foo(id) values(?)', [[i] for i in range(10)])
+    con.rollback()
+    eq_([], con.execute_all('select * from foo'))
+
+def test_sharded_conn_custom_route(tmpdir):
+    dbnames = [str(tmpdir.join('shard%d.db' % i)) for i in range(2)]
+    con = ShardedConn(dbnames, True, route=lambda key, count: 0 if key < 'm' else 1)
+    con.execute_all('create table foo(bar TEXT)')
+    con.execute('apple', 'insert into foo(bar) values(?)', ['apple'])
+    con.execute('pear', 'insert into foo(bar) values(?)', ['pear'])
+    eq_([('apple', )], con.shards[0].execute('select * from foo'))
+    eq_([('pear', )], con.shards[1].execute('select * from foo'))
+
+def test_sharded_conn_exception(tmpdir):
+    dbnames = [str(tmpdir.join('shard%d.db' % i)) for i in range(2)]
+    con = ShardedConn(dbnames, True)
+    with raises(sqlite.OperationalError):
+        con.execute_all('select * from bleh')
+
+def test_profile(tmpdir):
+    con = ThreadedConn(str(tmpdir.join('foo.db')), True, profile='interactive')
+    eq_(('wal', ), con.execute('pragma journal_mode')[0])
+    eq_((1, ), con.execute('pragma synchronous')[0]) # NORMAL
+    eq_((-64 * 1024, ), con.execute('pragma cache_size')[0])
+    con.set_profile('durable')
+    eq_('durable', con.profile)
+    eq_((2, ), con.execute('pragma synchronous')[0]) # FULL
+    con.set_profile('bulk-load')
+    eq_(('memory', ), con.execute('pragma journal_mode')[0])
+    eq_((0, ), con.execute('pragma synchronous')[0]) # OFF
+
+def test_unknown_profile():
+    with raises(ValueError):
+        ThreadedConn(':memory:', True, profile='bleh')
+    with raises(ValueError):
+        profile_queries('bleh')
+
+def test_pooled_conn_profile_keeps_wal(tmpdir):
+    con = PooledConn(str(tmpdir.join('foo.db')), True, readers=1, profile='bulk-load')
+    eq_(('wal', ), con._t.execute('pragma journal_mode')[0])
+    eq_((-256 * 1024, ), con._readers[0].execute('pragma cache_size')[0])
+    con.set_profile('durable')
+    eq_(('wal', ), con._t.execute('pragma journal_mode')[0])
+    eq_((2, ), con._readers[0].execute('pragma synchronous')[0])
+
+def test_maintenance_runs_when_idle(tmpdir):
+    con = ThreadedConn(str(tmpdir.join('foo.db')), True, maintenance_idle=0.1, profile='durable')
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('create index foo_bar on foo(bar)')
+    con.executemany('insert into foo(bar) values(?)', [[i] for i in range(100)])
+    assert con.maintenance_last_run['analyze'] is None
+    time.sleep(0.5)
+    last_run = con.maintenance_last_run
+    assert all(t is not None for t in last_run.values())
+    # analyze ran
+    assert con.execute('select * from sqlite_stat1')
+    # The analysis limit it sets isn't left behind
+    eq_([(0, )], con.execute('PRAGMA analysis_limit'))
+
+def test_maintenance_error_doesnt_kill_db_thread():
+    def analyze(con):
+        raise TypeError()
+    
+    con = ThreadedConn(':memory:', True, maintenance_idle=0.2)
+    con._t._maintain_analyze = analyze
+    time.sleep(0.5)
+    assert con.maintenance_last_run['analyze'] is not None
+    eq_([(1, )], con.execute('select 1'))
+
+def test_maintenance_incremental_vacuum_in_slices(tmpdir):
+    con = ThreadedConn(str(tmpdir.join('foo.db')), True, maintenance_idle=0.1)
+    con.execute('pragma auto_vacuum = incremental')
+    con.execute('create table foo(bar TEXT)')
+    con.executemany('insert into foo(bar) values(?)', [['x' * 1000] for i in range(1000)])
+    con.execute('delete from foo')
+    assert con.execute('pragma freelist_count')[0][0] > 200
+    deadline = time.time() + 10
+    while con.maintenance_last_run['incremental_vacuum'] is None and time.time() < deadline:
+        time.sleep(0.05)
+    eq_((0, ), con.execute('pragma freelist_count')[0])
+
+def test_maintenance_waits_for_idle_time():
+    con = ThreadedConn(':memory:', True, maintenance_idle=10)
+    con.execute('select 1')
+    time.sleep(0.2)
+    assert con.maintenance_last_run['analyze'] is None
+
+def test_maintenance_interval():
+    con = ThreadedConn(':memory:', True, maintenance_idle=0.05, maintenance_interval=100)
+    time.sleep(0.3)
+    first_run = con.maintenance_last_run['analyze']
+    assert first_run is not None
+    con.execute('select 1')
+    time.sleep(0.3)
+    eq_(first_run, con.maintenance_last_run['analyze'])
+
+def test_maintenance_waits_for_pending_transaction():
+    con = ThreadedConn(':memory:', False, maintenance_idle=0.05)
+    con.execute('create table foo(bar INTEGER)')
+    con.execute('insert into foo(bar) values(1)')
+    time.sleep(0.3)
+    assert con.maintenance_last_run['analyze'] is None
+    con.rollback()
+    eq_(0, len(con.execute('select * from foo')))